@@ -0,0 +1,330 @@
+"""
+linkemu module - a local UDP proxy that emulates a lossy link between
+a TFTP client and a TFTP server, and a benchmark of get/put transfers
+through it.
+
+Usage:
+  linkemu.py proxy [options] [--listen-port=<port>] <server> [<serv_port>]
+  linkemu.py bench [options] [--size=<bytes>] [--runs=<n>] [--timeout=<secs>]
+                   [--retransmit=<secs>]
+
+Options:
+-h --help               show help
+proxy                   forward packets between local clients and <server>
+bench                   measure get and put transfers through an emulated link
+--loss=<prob>           [default: 0] probability of dropping a packet
+--delay=<secs>          [default: 0] one way latency
+--jitter=<secs>         [default: 0] random extra latency, up to this value
+--duplicate=<prob>      [default: 0] probability of sending a packet twice
+--reorder=<prob>        [default: 0] probability of holding a packet back, so
+                        that the next packets overtake it
+--bandwidth=<bytes/s>   [default: 0] link capacity, 0 means unlimited
+--seed=<n>              seed of the random generator, for repeatable runs
+--listen-port=<port>    [default: 6969] port where clients reach the proxy
+--size=<bytes>          [default: 1048576] size of the transferred file
+--runs=<n>              [default: 1] number of get and put transfers
+--timeout=<secs>        [default: 5] transfer inactivity timeout
+--retransmit=<secs>     [default: 1] wait for a reply before resending a packet
+server                  TFTP server IP or name
+serv_port               [default: 69] TFTP server port
+
+The link conditions apply to both directions. LinkConditions may be
+given separately for each direction when using LinkProxy directly.
+"""
+
+import heapq
+import io
+import random
+import selectors
+import socket
+import threading
+import time
+from typing import List, NamedTuple
+
+import tftp
+
+UP = 0                        # client to server
+DOWN = 1                      # server to client
+REORDER_DELAY = 0.01          # secs a reordered packet is held back
+SESSION_TIMEOUT = 2 * tftp.INACTIVITY_TIMEOUT
+
+class LinkConditions(NamedTuple):
+    loss: float = 0.0         # probability
+    delay: float = 0.0        # secs
+    jitter: float = 0.0       # secs
+    duplicate: float = 0.0    # probability
+    reorder: float = 0.0      # probability
+    bandwidth: float = 0.0    # bytes/s, 0 means unlimited
+#:
+
+PERFECT_LINK = LinkConditions()
+
+################################################################################
+##
+##      PROXY
+##
+################################################################################
+
+class _Session:
+    """
+    Sockets of the proxy for one client. server_sock talks to the
+    server; fronts has one socket per server address (port 69 and the
+    TID of each transfer), so that the client sees the TID switch.
+    """
+    def __init__(self, client_addr):
+        self.client_addr = client_addr
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_sock.bind(('', 0))
+        self.fronts = {}
+        self.last_active = time.monotonic()
+    #:
+
+    def close(self):
+        self.server_sock.close()
+        for front in self.fronts.values():
+            front.close()
+    #:
+#:
+
+class LinkProxy:
+    """
+    Forwards UDP packets between clients, that send their requests to
+    address, and the TFTP server at server_addr, applying the up (client
+    to server) and down (server to client) link conditions. Runs in its
+    own thread between start() and stop(), or as a context manager.
+    """
+    def __init__(self, server_addr: tftp.INET4Address,
+                 up: LinkConditions = PERFECT_LINK, down: LinkConditions = PERFECT_LINK,
+                 listen_addr: tftp.INET4Address = ('127.0.0.1', 0), seed=None):
+        self.server_addr = server_addr
+        self.conditions = (up, down)
+        self.dropped = [0, 0]
+        self.forwarded = [0, 0]
+        self._random = random.Random(seed)
+        self._link_free = [0.0, 0.0]
+        self._queue = []      # heap of (due time, sequence, sock, packet, addr)
+        self._seq = 0
+        self._sessions = {}
+        self._selector = selectors.DefaultSelector()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(listen_addr)
+        self._selector.register(self._sock, selectors.EVENT_READ, self._from_client)
+        self._running = False
+        self._thread = None
+    #:
+
+    @property
+    def address(self) -> tftp.INET4Address:
+        return self._sock.getsockname()
+    #:
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+    #:
+
+    def serve_forever(self):
+        self._running = True
+        self._run()
+    #:
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+        self._selector.close()
+        self._sock.close()
+    #:
+
+    def __enter__(self):
+        return self.start()
+    #:
+
+    def __exit__(self, *exc_info):
+        self.stop()
+    #:
+
+    def _run(self):
+        last_purge = time.monotonic()
+        while self._running:
+            now = time.monotonic()
+            timeout = 0.05
+            if self._queue:
+                timeout = min(timeout, max(self._queue[0][0] - now, 0))
+            for key, _ in self._selector.select(timeout):
+                try:
+                    packet, addr = key.fileobj.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+                except OSError:
+                    continue
+                key.data(key.fileobj, packet, addr)
+            now = time.monotonic()
+            while self._queue and self._queue[0][0] <= now:
+                _, _, sock, packet, addr = heapq.heappop(self._queue)
+                try:
+                    sock.sendto(packet, addr)
+                except OSError:
+                    pass
+            if now - last_purge > 1.0:
+                self._purge_sessions(now)
+                last_purge = now
+    #:
+
+    def _from_client(self, sock, packet: bytes, client_addr):
+        session = self._sessions.get(client_addr)
+        if session is None:
+            session = _Session(client_addr)
+            self._sessions[client_addr] = session
+            self._selector.register(session.server_sock, selectors.EVENT_READ,
+                                    lambda sock, packet, addr: self._from_server(session, packet, addr))
+        session.last_active = time.monotonic()
+        self._schedule(UP, session.server_sock, packet, self.server_addr)
+    #:
+
+    def _from_server(self, session: _Session, packet: bytes, server_addr):
+        front = session.fronts.get(server_addr)
+        if front is None:
+            front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            front.bind((self._sock.getsockname()[0], 0))
+            session.fronts[server_addr] = front
+            self._selector.register(front, selectors.EVENT_READ,
+                                    lambda sock, packet, addr: self._from_front(session, server_addr, packet))
+        session.last_active = time.monotonic()
+        self._schedule(DOWN, front, packet, session.client_addr)
+    #:
+
+    def _from_front(self, session: _Session, server_addr, packet: bytes):
+        session.last_active = time.monotonic()
+        self._schedule(UP, session.server_sock, packet, server_addr)
+    #:
+
+    def _schedule(self, direction: int, sock, packet: bytes, addr):
+        cond = self.conditions[direction]
+        rand = self._random.random
+        if cond.loss and rand() < cond.loss:
+            self.dropped[direction] += 1
+            return
+        copies = 2 if cond.duplicate and rand() < cond.duplicate else 1
+        for _ in range(copies):
+            now = time.monotonic()
+            due = now + cond.delay + (cond.jitter * rand() if cond.jitter else 0.0)
+            if cond.bandwidth:
+                # Packets leave one after the other at the link rate
+                start = max(now, self._link_free[direction])
+                self._link_free[direction] = start + len(packet) / cond.bandwidth
+                due += self._link_free[direction] - now
+            if cond.reorder and rand() < cond.reorder:
+                due += REORDER_DELAY
+            self._seq += 1
+            heapq.heappush(self._queue, (due, self._seq, sock, packet, addr))
+            self.forwarded[direction] += 1
+    #:
+
+    def _purge_sessions(self, now: float):
+        for client_addr, session in list(self._sessions.items()):
+            if now - session.last_active > SESSION_TIMEOUT:
+                for sock in (session.server_sock, *session.fronts.values()):
+                    self._selector.unregister(sock)
+                session.close()
+                del self._sessions[client_addr]
+    #:
+#:
+
+################################################################################
+##
+##      BENCHMARK
+##
+################################################################################
+
+class BenchmarkResult(NamedTuple):
+    operation: str            # 'get' or 'put'
+    size: int                 # bytes
+    completed: bool
+    duration: float           # secs
+    throughput: float         # bytes/s, 0 if not completed
+    error: str
+#:
+
+def _timed(operation: str, size: int, transfer, check) -> BenchmarkResult:
+    start = time.perf_counter()
+    try:
+        transfer()
+    except (tftp.NetworkError, tftp.Err, ValueError, OSError) as ex:
+        return BenchmarkResult(operation, size, False, time.perf_counter() - start, 0.0,
+                               f'{type(ex).__name__}: {ex}')
+    duration = time.perf_counter() - start
+    if not check():
+        return BenchmarkResult(operation, size, False, duration, 0.0, 'data differs from the source')
+    return BenchmarkResult(operation, size, True, duration, size / duration if duration else 0.0, '')
+#:
+
+def benchmark(up: LinkConditions = PERFECT_LINK, down: LinkConditions = PERFECT_LINK,
+              size: int = 2**20, runs: int = 1, timeout: float = 5.0, seed=None,
+              retransmit: float = tftp.RETRANSMIT_TIMEOUT) -> List[BenchmarkResult]:
+    """
+    Starts a server with an in-memory file of size bytes and a LinkProxy
+    in front of it, then times runs get_to and put_from transfers
+    through the proxy. The file holds random bytes (from seed), and the
+    data received by each transfer is compared with them: transfers that
+    fail or deliver other data are reported as not completed. Both sides resend a lost packet after retransmit secs and give up
+    after timeout secs of inactivity (see tftp.iter_get).
+    """
+    # Imported here so that the proxy can be used without the server
+    import server
+    import storage
+
+    data = random.Random(seed).randbytes(size)
+    file_storage = storage.MemoryStorage({'bench.bin': data})
+    serv = server.TFTPServer(('127.0.0.1', 0), server.PacketHandler, file_storage, timeout, retransmit)
+    serv_thread = threading.Thread(target=serv.serve_forever, daemon=True)
+    serv_thread.start()
+    results = []
+    try:
+        with LinkProxy(serv.server_address, up, down, seed=seed) as proxy:
+            for run in range(runs):
+                received = io.BytesIO()
+                results.append(_timed('get', size, lambda: tftp.get_to(
+                    proxy.address, 'bench.bin', received, timeout=timeout, retransmit=retransmit),
+                    lambda: received.getvalue() == data))
+                name = f'bench{run}.bin'
+                results.append(_timed('put', size, lambda: tftp.put_from(
+                    proxy.address, [data], name, timeout=timeout, retransmit=retransmit),
+                    lambda: file_storage.open_read(name).read() == data))
+    finally:
+        serv.shutdown()
+        serv.server_close()
+    return results
+#:
+
+def format_result(result: BenchmarkResult) -> str:
+    if result.completed:
+        return (f'{result.operation}: {result.size} bytes in {result.duration:.3f} s '
+                f'({result.throughput:.0f} bytes/s)')
+    return f'{result.operation}: failed after {result.duration:.3f} s ({result.error})'
+#:
+
+if __name__ == '__main__':
+    import docopt
+    args = docopt.docopt(__doc__)
+    conditions = LinkConditions(float(args['--loss']), float(args['--delay']),
+                                float(args['--jitter']), float(args['--duplicate']),
+                                float(args['--reorder']), float(args['--bandwidth']))
+    seed = int(args['--seed']) if args['--seed'] else None
+    if args['proxy']:
+        server_ip, _ = tftp.get_server_info(args['<server>'])
+        proxy = LinkProxy((server_ip, int(args['<serv_port>'] or 69)), conditions, conditions,
+                          ('', int(args['--listen-port'])), seed)
+        print(f'Forwarding port {proxy.address[1]} to {server_ip}')
+        try:
+            proxy.serve_forever()
+        except KeyboardInterrupt:
+            proxy.stop()
+    else:
+        for result in benchmark(conditions, conditions, int(args['--size']), int(args['--runs']),
+                                float(args['--timeout']), seed, float(args['--retransmit'])):
+            print(format_result(result))
+#:
@@ -0,0 +1,224 @@
+"""
+profiling module - opt-in instrumentation of TFTP transfers.
+
+Two independent tools, both controlled by the module 'settings' and
+switchable while the server runs (see install_signal_handlers):
+    phase timing    time spent in each phase of every transfer: disk
+                    reads and writes, packet packing, sendto, recvfrom
+                    waits, and everything else (Python overhead)
+    profiling       a chosen fraction of the transfers runs under
+                    cProfile, or under a sampling profiler, and the
+                    results are dumped to settings.output_dir
+
+Transfers are instrumented by running them inside profile_transfer:
+
+    with profiling.profile_transfer('get-boot.img') as phases:
+        tftp.get_file(...)
+    print(phases)     # {'read': ..., 'pack': ..., 'send': ..., ...}
+"""
+
+import cProfile
+import logging
+import os
+import random
+import re
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import tftp
+
+PHASES = ('read', 'pack', 'send', 'recv', 'write')
+CPROFILE = 'cprofile'
+SAMPLING = 'sample'
+SAMPLE_INTERVAL = 0.005       # secs between samples of the sampling profiler
+
+logger = logging.getLogger('tftp.profiling')
+
+class ProfilingSettings:
+    """
+    What profile_transfer does. Attributes may be changed at any time;
+    transfers already running keep the settings they started with.
+    """
+    def __init__(self):
+        self.timing = False               # per-phase timing of every transfer
+        self.profile_rate = 0.0           # fraction of transfers to profile
+        self.profiler = CPROFILE          # CPROFILE or SAMPLING
+        self.output_dir = '.'             # where profiles are dumped
+    #:
+#:
+
+settings = ProfilingSettings()
+
+################################################################################
+##
+##      PHASE TIMING
+##
+################################################################################
+
+class PhaseTimer:
+    """
+    Accumulates the time a transfer spends in each phase. Used by a
+    single thread, through tftp.set_phase_timer.
+    """
+    def __init__(self):
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.start = time.perf_counter()
+        self.total = 0.0
+    #:
+
+    def add(self, phase: str, secs: float):
+        self.phases[phase] += secs
+    #:
+
+    def stop(self) -> Dict[str, float]:
+        """
+        Stops the timer and returns the secs spent in each phase,
+        including 'other' for the time outside of every phase.
+        """
+        self.total = time.perf_counter() - self.start
+        result = {phase: self.phases.get(phase, 0.0) for phase in PHASES}
+        result['other'] = max(self.total - sum(result.values()), 0.0)
+        return result
+    #:
+#:
+
+################################################################################
+##
+##      PROFILERS
+##
+################################################################################
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval secs from a
+    background thread. Much cheaper than cProfile for long transfers,
+    and doesn't conflict with other profilers. The result is written in
+    the collapsed stack format read by flame graph tools.
+    """
+    def __init__(self, thread_id: int = None, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples: Dict[str, int] = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = None
+    #:
+
+    def enable(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    #:
+
+    def disable(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    #:
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+    #:
+
+    def dump_stats(self, path: str):
+        with open(path, 'w') as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write(f'{stack} {count}\n')
+    #:
+#:
+
+def _start_profiler(profiler_name: str):
+    """
+    Returns a started profiler, or None if it can't be started (since
+    Python 3.12 only one cProfile may be active at a time).
+    """
+    profiler = SamplingProfiler() if profiler_name == SAMPLING else cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as ex:
+        logger.info('profiler not started: %s', ex)
+        return None
+    return profiler
+#:
+
+def _dump_profile(profiler, profiler_name: str, label: str):
+    suffix = 'folded' if profiler_name == SAMPLING else 'pstats'
+    label = re.sub(r'[^\w.-]', '_', label)
+    path = os.path.join(settings.output_dir, f'{label}-{time.time():.6f}.{suffix}')
+    try:
+        profiler.dump_stats(path)
+    except OSError as ex:
+        logger.warning('profile not written: %s', ex)
+        return
+    logger.info('profile written', extra={'path': path})
+#:
+
+@contextmanager
+def profile_transfer(label: str) -> Iterator[Dict[str, float]]:
+    """
+    Instruments the transfers run by the calling thread inside the with
+    block, according to settings. Yields a dict that, when phase timing
+    is on, is filled with the secs spent in each phase on exit. Profiles
+    are dumped to settings.output_dir, in files named after label.
+    """
+    phases: Dict[str, float] = {}
+    timer = PhaseTimer() if settings.timing else None
+    profiler_name = settings.profiler
+    profiler = None
+    if settings.profile_rate and random.random() < settings.profile_rate:
+        profiler = _start_profiler(profiler_name)
+    tftp.set_phase_timer(timer)
+    try:
+        yield phases
+    finally:
+        tftp.set_phase_timer(None)
+        if profiler is not None:
+            profiler.disable()
+            _dump_profile(profiler, profiler_name, label)
+        if timer is not None:
+            phases.update(timer.stop())
+#:
+
+################################################################################
+##
+##      RUNTIME CONTROL
+##
+################################################################################
+
+def install_signal_handlers(profile_rate: float = 0.1):
+    """
+    Lets the operator switch instrumentation without restarting:
+        SIGUSR1     toggles phase timing
+        SIGUSR2     toggles profiling of profile_rate of the transfers
+                    (or of the current settings.profile_rate, if set)
+    Must be called from the main thread. Does nothing on platforms
+    without these signals.
+    """
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    default_rate = settings.profile_rate or profile_rate
+
+    def toggle_timing(signum, frame):
+        settings.timing = not settings.timing
+        logger.warning('phase timing %s', 'on' if settings.timing else 'off')
+
+    def toggle_profiling(signum, frame):
+        settings.profile_rate = 0.0 if settings.profile_rate else default_rate
+        logger.warning('profiling %s', f'on ({settings.profile_rate:.0%} of transfers)'
+                       if settings.profile_rate else 'off')
+
+    signal.signal(signal.SIGUSR1, toggle_timing)
+    signal.signal(signal.SIGUSR2, toggle_profiling)
+#:
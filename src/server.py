@@ -1,6 +1,22 @@
 '''
 server module - defines the specific functions and procedures of a TFTP server.
 
+Usage:
+  server.py [--trace=<trace_file>] [--log-level=<level>] [--timing]
+            [--profile=<fraction>] [--profiler=<name>] [--profile-dir=<dir>]
+            [--rescan=<secs>] [--ignore-case] [<root>]
+
+Options:
+-h --help               show help
+--trace=<trace_file>    record every transfer packet to trace_file (see the tracing module)
+--log-level=<level>     [default: INFO] DEBUG, INFO, WARNING or ERROR
+--timing                log the time each transfer spends in each phase
+--profile=<fraction>    [default: 0] fraction of the transfers to profile
+--profiler=<name>       [default: cprofile] cprofile or sample
+--profile-dir=<dir>     [default: .] where to write the profiles
+--rescan=<secs>         [default: 10] how often to rebuild the index of served files
+--ignore-case           match requested file names regardless of case
+root                    [default: .] directory or zip/tar archive to serve
 
 
 Developed by:
@@ -10,34 +26,134 @@ Developed by:
 2022/07/01
 '''
 
-from socketserver import ThreadingUDPServer, DatagramRequestHandler
+from socketserver import ThreadingUDPServer, BaseRequestHandler
 from threading import Thread
 import tftp
+import storage
+import tracing
+import tftplog
+import profiling
+import io
 import os
+import time
+import logging
 
 N_CONN = 16
 
-class PacketHandler(DatagramRequestHandler):
+logger = logging.getLogger('tftp.server')
+
+class TFTPServer(ThreadingUDPServer):
+    """
+    A TFTP server serving the files of a storage backend (see the
+    storage module). By default, the current directory is served.
+    """
+    def __init__(self, server_address, handler_class, file_storage=None,
+                 transfer_timeout: float = tftp.INACTIVITY_TIMEOUT,
+                 retransmit_timeout: float = tftp.RETRANSMIT_TIMEOUT):
+        super().__init__(server_address, handler_class)
+        self.storage = file_storage if file_storage is not None else storage.DirectoryStorage('.')
+        # Passed to the tftp *_resp functions (BaseServer.timeout is
+        # something else: the wait of handle_request)
+        self.transfer_timeout = transfer_timeout
+        self.retransmit_timeout = retransmit_timeout
+    #:
+#:
+
+class PacketHandler(BaseRequestHandler):
     def handle(self):
-        print('Connection:', self.client_address)
         # Get message and client socket
         packet, sock = self.request
-        opcode = tftp.unpack_opcode(packet)
-        file_name, mode = tftp.unpack_rrq(packet)
+        logger.debug('Connection from %s:%s', *self.client_address)
+        try:
+            opcode = tftp.unpack_opcode(packet)
+            if opcode not in (tftp.RRQ, tftp.WRQ):
+                raise ValueError(f'Unexpected opcode {opcode}.')
+            file_name, mode = tftp.unpack_rrq(packet)
+        except ValueError as ex:
+            logger.debug('Invalid request from %s:%s: %s', *self.client_address, ex)
+            sock.sendto(tftp.pack_err(tftp.ILLEGAL_OPERATION), self.client_address)
+            return
+        file_storage = self.server.storage
 
-        if opcode == 1:
-            if file_name != '':        
-                tftp.get_resp(self.client_address, file_name)
+        if opcode == tftp.RRQ:
+            if file_name != '':
+                self.transfer('get', file_name, file_storage.open_read, tftp.get_resp)
             else:
-                print("************DIR************")
-                tftp.dir_resp(self.client_address, file_name)
-                #data = os.popen(f"ls -l").read().encode()
-                #if file_name != 'dir':
-                
+                self.transfer('dir', file_name, lambda _: io.BytesIO(file_storage.listing()),
+                              lambda addr, name, file, **options:
+                                  tftp.dir_resp(addr, name, file.getvalue(), **options))
+        else:
+            self.transfer('put', file_name, file_storage.open_write,
+                          lambda addr, name, file, **options:
+                              tftp.put_resp(addr, name, file, on_complete=file.commit, **options))
+
+    def transfer(self, operation: str, file_name: str, open_func, transfer_func):
+        """
+        Opens file_name with open_func and runs transfer_func, one of the
+        tftp *_resp functions, on it. Logs a summary of the transfer, with
+        the time spent in each phase if phase timing is on (see the
+        profiling module).
+        """
+        file = self.open_file(open_func, file_name)
+        if file is None:
+            return
+        start = time.perf_counter()
+        # Keeps the counts so far if the transfer fails
+        counter = tftp.TransferCounter()
+        error = ''
+        with profiling.profile_transfer(f'{operation}-{file_name}') as phases:
+            try:
+                # An upload (storage.Upload) is committed by put_resp once the
+                # last block arrives; leaving the with block through an error
+                # before that discards it
+                with file:
+                    transfer_func(self.client_address, file_name, file,
+                                  timeout=self.server.transfer_timeout,
+                                  retransmit=self.server.retransmit_timeout, counter=counter)
+            except (tftp.NetworkError, tftp.Err, ValueError, OSError) as ex:
+                error = f'{type(ex).__name__}: {ex}'
+        tftplog.log_transfer(logger, operation, self.client_address, file_name,
+                             counter.bytes, time.perf_counter() - start, error,
+                             counter.retransmits, **phases)
+    #:
+
+    def open_file(self, open_func, file_name):
+        """
+        Opens file_name with open_func, a storage method. Returns None
+        and replies with the matching TFTP error if that fails.
+        """
+        try:
+            return open_func(file_name)
+        except OSError as ex:
+            logger.info('request refused: %s', ex, extra={'client': f'{self.client_address[0]}:{self.client_address[1]}'})
+            _, sock = self.request
+            sock.sendto(tftp.pack_err(tftp.error_code(ex)), self.client_address)
+            return None
+    #:
+#:
+
 if __name__ == '__main__':
-    serv = ThreadingUDPServer(('', 69), PacketHandler)
+    import docopt
+    args = docopt.docopt(__doc__)
+    log_listener = tftplog.setup_logging(args['--log-level'])
+    profiling.settings.timing = args['--timing']
+    profiling.settings.profile_rate = float(args['--profile'])
+    profiling.settings.profiler = args['--profiler']
+    profiling.settings.output_dir = args['--profile-dir']
+    # SIGUSR1 toggles phase timing, SIGUSR2 toggles profiling
+    profiling.install_signal_handlers()
+    if args['--trace']:
+        tftp.set_tracer(tracing.TraceRecorder(args['--trace']))
+    file_storage = storage.IndexedStorage(storage.open_storage(args['<root>'] or '.'),
+                                          float(args['--rescan']), args['--ignore-case'])
+    serv = TFTPServer(('', 69), PacketHandler, file_storage)
     for n in range(N_CONN):
         t = Thread(target=serv.serve_forever)
         t.daemon = True
         t.start()
-    serv.serve_forever()
+    try:
+        serv.serve_forever()
+    finally:
+        if tftp.tracer is not None:
+            tftp.tracer.close()
+        log_listener.stop()
@@ -0,0 +1,659 @@
+"""
+storage module - defines the storage backends used by the TFTP server
+to read, write and list the files it serves.
+
+A backend maps relative, '/'-separated names to files. The available
+backends are:
+    DirectoryStorage  - a directory of the local file system, with every
+                        name confined to that directory (chroot-like)
+    MemoryStorage     - a dict of names to bytes, kept in RAM
+    ArchiveStorage    - a read-only zip or tar bundle, served without
+                        unpacking it to disk
+    IndexedStorage    - any of the above, looked up through an in-memory
+                        index of its files
+"""
+
+import io
+import os
+import posixpath
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from typing import BinaryIO, Dict, List, NamedTuple, Optional
+
+BLOCK_SIZE = 512              # bytes, same as tftp.MAX_DATA_LEN
+UPLOAD_PREFIX = '.tftp-upload-'   # temporary files of uploads in progress
+
+class FileInfo(NamedTuple):
+    name: str
+    size: int                 # bytes
+    mtime: float              # seconds since the epoch
+#:
+
+def normalize_name(name: str) -> str:
+    """
+    Returns the canonical form of a requested file name: '/' separated,
+    relative and without '.' or empty components. Raises PermissionError
+    if name tries to escape the served tree through '..'.
+    """
+    name = name.replace('\\', '/').lstrip('/')
+    norm_name = posixpath.normpath(name) if name else ''
+    if norm_name in ('', '.'):
+        raise FileNotFoundError(f"Invalid file name '{name}'.")
+    if norm_name == '..' or norm_name.startswith('../'):
+        raise PermissionError(f"'{name}': outside of the served tree.")
+    return norm_name
+#:
+
+def format_listing(entries: List[FileInfo]) -> bytes:
+    """
+    Formats a list of files, one per line, as sent in the response of
+    a DIR request.
+    """
+    lines = []
+    for entry in sorted(entries):
+        mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.mtime))
+        lines.append(f'{entry.size:>12}  {mtime}  {entry.name}\n')
+    return ''.join(lines).encode()
+#:
+
+################################################################################
+##
+##      STORAGE BACKENDS
+##
+################################################################################
+
+class Storage:
+    """
+    Base class of the storage backends. Every method expects a file
+    name as received in a RRQ or WRQ and raises FileNotFoundError,
+    PermissionError or FileExistsError, which the server turns into
+    the matching TFTP error.
+    """
+    read_only = False
+
+    def stat(self, name: str) -> FileInfo:
+        raise NotImplementedError
+    #:
+
+    def open_read(self, name: str) -> BinaryIO:
+        """
+        Returns a seekable binary file object for the contents of name.
+        """
+        raise NotImplementedError
+    #:
+
+    def open_write(self, name: str) -> 'Upload':
+        """
+        Returns an Upload for a new file name. Raises FileExistsError if
+        name already exists.
+        """
+        raise PermissionError(f"'{name}': read-only storage.")
+    #:
+
+    def list(self) -> List[FileInfo]:
+        raise NotImplementedError
+    #:
+
+    def listing(self) -> bytes:
+        return format_listing(self.list())
+    #:
+
+    def read_block(self, name: str, block_number: int, block_size: int = BLOCK_SIZE) -> bytes:
+        """
+        Random access read of data block block_number (the first block
+        is 1, as in DAT packets) of file name.
+        """
+        with self.open_read(name) as file:
+            file.seek((block_number - 1) * block_size)
+            return file.read(block_size)
+    #:
+#:
+
+class Upload:
+    """
+    A file being received through a WRQ. Its contents only become part
+    of the storage when commit() is called; close() without commit()
+    discards them. Used as a context manager, it commits when the with
+    block ends normally and discards the upload if it raises, so that
+    an aborted transfer never leaves a truncated file behind.
+    """
+    def __init__(self):
+        self.done = False
+    #:
+
+    def write(self, data: bytes) -> int:
+        raise NotImplementedError
+    #:
+
+    def commit(self):
+        self.done = True
+    #:
+
+    def abort(self):
+        self.done = True
+    #:
+
+    def close(self):
+        if not self.done:
+            self.abort()
+    #:
+
+    def __enter__(self):
+        return self
+    #:
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.done:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+    #:
+#:
+
+class DirectoryStorage(Storage):
+    """
+    Serves the files under the root directory. Names are resolved
+    relative to root and may not leave it, not even through symlinks.
+    """
+    def __init__(self, root: str = '.', read_only: bool = False):
+        self.root = os.path.realpath(root)
+        self.read_only = read_only
+        if not os.path.isdir(self.root):
+            raise ValueError(f"'{root}' is not a directory.")
+    #:
+
+    def _path(self, name: str) -> str:
+        path = os.path.realpath(os.path.join(self.root, normalize_name(name)))
+        if os.path.commonpath((self.root, path)) != self.root:
+            raise PermissionError(f"'{name}': outside of the served tree.")
+        return path
+    #:
+
+    def stat(self, name: str) -> FileInfo:
+        path = self._path(name)
+        st = os.stat(path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"'{name}': not a regular file.")
+        return FileInfo(normalize_name(name), st.st_size, st.st_mtime)
+    #:
+
+    def open_read(self, name: str) -> BinaryIO:
+        path = self._path(name)
+        # Checked before opening: opening a FIFO blocks until a writer shows up
+        if not stat.S_ISREG(os.stat(path).st_mode):
+            raise FileNotFoundError(f"'{name}': not a regular file.")
+        return open(path, 'rb')
+    #:
+
+    def open_write(self, name: str) -> Upload:
+        if self.read_only:
+            return super().open_write(name)
+        path = self._path(name)
+        if os.path.lexists(path):
+            raise FileExistsError(f"'{name}': file already exists.")
+        return _DirectoryUpload(path)
+    #:
+
+    def list(self) -> List[FileInfo]:
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            dir_names.sort()
+            rel_dir = os.path.relpath(dir_path, self.root)
+            for file_name in file_names:
+                if file_name.startswith(UPLOAD_PREFIX):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                # Skip symlinks to files outside of root, they can't be served
+                if os.path.commonpath((self.root, os.path.realpath(path))) != self.root:
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                # FIFOs and devices would block or never end when read
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                name = posixpath.normpath(posixpath.join(rel_dir.replace(os.sep, '/'), file_name))
+                entries.append(FileInfo(name, st.st_size, st.st_mtime))
+        return entries
+    #:
+#:
+
+class _DirectoryUpload(Upload):
+    """
+    Receives the file in a hidden temporary file next to path, which is
+    linked to path on commit.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        dir_name, base_name = os.path.split(path)
+        fd, self.temp_path = tempfile.mkstemp(prefix=f'{UPLOAD_PREFIX}{base_name}.', dir=dir_name)
+        self._file = os.fdopen(fd, 'wb')
+    #:
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+    #:
+
+    def commit(self):
+        self._file.close()
+        try:
+            # link, unlike rename, fails if another upload created path meanwhile
+            os.link(self.temp_path, self.path)
+        except FileExistsError:
+            self.abort()
+            raise FileExistsError(f"'{self.path}': file already exists.") from None
+        except OSError:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.unlink(self.temp_path)
+        super().commit()
+    #:
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+        super().abort()
+    #:
+#:
+
+class MemoryStorage(Storage):
+    """
+    Serves files kept in memory. files maps names to their contents.
+    Files received through WRQ are stored once completely written.
+    """
+    def __init__(self, files: Optional[Dict[str, bytes]] = None, read_only: bool = False):
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._files: Dict[str, FileInfo] = {}
+        self._data: Dict[str, bytes] = {}
+        for name, data in (files or {}).items():
+            self.store(name, data)
+    #:
+
+    def store(self, name: str, data: bytes, mtime: Optional[float] = None):
+        name = normalize_name(name)
+        data = bytes(data)
+        with self._lock:
+            self._data[name] = data
+            self._files[name] = FileInfo(name, len(data), time.time() if mtime is None else mtime)
+    #:
+
+    def stat(self, name: str) -> FileInfo:
+        try:
+            return self._files[normalize_name(name)]
+        except KeyError:
+            raise FileNotFoundError(f"'{name}': file not found.") from None
+    #:
+
+    def open_read(self, name: str) -> BinaryIO:
+        try:
+            return io.BytesIO(self._data[normalize_name(name)])
+        except KeyError:
+            raise FileNotFoundError(f"'{name}': file not found.") from None
+    #:
+
+    def open_write(self, name: str) -> Upload:
+        if self.read_only:
+            return super().open_write(name)
+        norm_name = normalize_name(name)
+        if norm_name in self._files:
+            raise FileExistsError(f"'{name}': file already exists.")
+        return _MemoryUpload(self, norm_name)
+    #:
+
+    def _store_new(self, name: str, data: bytes):
+        with self._lock:
+            if name in self._files:
+                raise FileExistsError(f"'{name}': file already exists.")
+            self._data[name] = data
+            self._files[name] = FileInfo(name, len(data), time.time())
+    #:
+
+    def list(self) -> List[FileInfo]:
+        with self._lock:
+            return list(self._files.values())
+    #:
+#:
+
+class _MemoryUpload(Upload):
+    def __init__(self, storage: MemoryStorage, name: str):
+        super().__init__()
+        self._storage = storage
+        self._name = name
+        self._buffer = io.BytesIO()
+    #:
+
+    def write(self, data: bytes) -> int:
+        return self._buffer.write(data)
+    #:
+
+    def commit(self):
+        self._storage._store_new(self._name, self._buffer.getvalue())
+        self._buffer.close()
+        super().commit()
+    #:
+
+    def abort(self):
+        self._buffer.close()
+        super().abort()
+    #:
+#:
+
+class ArchiveStorage(Storage):
+    """
+    Serves the regular files of a zip or tar archive (optionally
+    compressed for tar). The archive is indexed once, when the storage
+    is created, and is never written to.
+    """
+    read_only = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._members: Dict[str, object] = {}
+        self._files: Dict[str, FileInfo] = {}
+        if zipfile.is_zipfile(path):
+            self._zip = zipfile.ZipFile(path)
+            self._tar_offsets = None
+            for info in self._zip.infolist():
+                if info.is_dir():
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                self._add(info.filename, info, info.file_size, mtime)
+        elif tarfile.is_tarfile(path):
+            self._zip = None
+            with tarfile.open(path) as tar:
+                # Members of an uncompressed tar can be read straight from
+                # the archive file, at their data offset
+                compressed = not isinstance(tar.fileobj, io.BufferedReader)
+                self._tar_offsets = None if compressed else {}
+                for member in tar.getmembers():
+                    if not member.isfile():
+                        continue
+                    name = self._add(member.name, member.name, member.size, member.mtime)
+                    if name and not compressed:
+                        self._tar_offsets[name] = member.offset_data
+        else:
+            raise ValueError(f"'{path}' is not a zip or tar archive.")
+    #:
+
+    def _add(self, name: str, member, size: int, mtime: float) -> Optional[str]:
+        try:
+            name = normalize_name(name)
+        except OSError:
+            return None
+        self._members[name] = member
+        self._files[name] = FileInfo(name, size, mtime)
+        return name
+    #:
+
+    def stat(self, name: str) -> FileInfo:
+        try:
+            return self._files[normalize_name(name)]
+        except KeyError:
+            raise FileNotFoundError(f"'{name}': file not found.") from None
+    #:
+
+    def open_read(self, name: str) -> BinaryIO:
+        info = self.stat(name)
+        member = self._members[info.name]
+        if self._zip is not None:
+            return self._zip.open(member)
+        if self._tar_offsets is not None:
+            return _FileSlice(self.path, self._tar_offsets[info.name], info.size)
+        return _TarMember(self.path, member)
+    #:
+
+    def list(self) -> List[FileInfo]:
+        return list(self._files.values())
+    #:
+#:
+
+class _FileSlice(io.RawIOBase):
+    """
+    Read-only view of size bytes of the file at path, starting at offset.
+    """
+    def __init__(self, path: str, offset: int, size: int):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+    #:
+
+    def readable(self):
+        return True
+    #:
+
+    def seekable(self):
+        return True
+    #:
+
+    def tell(self):
+        return self._pos
+    #:
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+    #:
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self._size - self._pos)
+        if count <= 0:
+            return 0
+        self._file.seek(self._offset + self._pos)
+        count = self._file.readinto(memoryview(buffer)[:count])
+        self._pos += count
+        return count
+    #:
+
+    def close(self):
+        self._file.close()
+        super().close()
+    #:
+#:
+
+class _TarMember(io.RawIOBase):
+    """
+    A member of a compressed tar, read through its own TarFile so that
+    concurrent transfers don't share the decompressor.
+    """
+    def __init__(self, path: str, member_name: str):
+        super().__init__()
+        self._tar = tarfile.open(path)
+        self._file = self._tar.extractfile(member_name)
+    #:
+
+    def readable(self):
+        return True
+    #:
+
+    def seekable(self):
+        return True
+    #:
+
+    def tell(self):
+        return self._file.tell()
+    #:
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        return self._file.seek(pos, whence)
+    #:
+
+    def readinto(self, buffer):
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+    #:
+
+    def close(self):
+        self._file.close()
+        self._tar.close()
+        super().close()
+    #:
+#:
+
+class IndexedStorage(Storage):
+    """
+    Wraps another backend with an in-memory index of its files, built
+    when created and rebuilt every rescan_interval secs (0 disables
+    rescans; rescan() may also be called at any time). Names are looked
+    up in the index, so a request for a missing file, or for a name
+    outside of the served tree, is refused without touching the backend.
+    With ignore_case, names match regardless of case, for clients that
+    change the case of file names; if several files differ only in case,
+    the first one in sorted order is served.
+    """
+    def __init__(self, backend: Storage, rescan_interval: float = 0, ignore_case: bool = False):
+        self.backend = backend
+        self.read_only = backend.read_only
+        self.ignore_case = ignore_case
+        self._files: Dict[str, FileInfo] = {}
+        self._folded: Dict[str, str] = {}     # lower case name => name
+        # _lock guards the index against _add; _added collects the files
+        # committed while a rescan lists the backend, which may have
+        # missed them
+        self._lock = threading.Lock()
+        self._rescan_lock = threading.Lock()
+        self._added: Optional[Dict[str, FileInfo]] = None
+        self.rescan()
+        self._stop = threading.Event()
+        if rescan_interval > 0:
+            thread = threading.Thread(target=self._rescan_loop, args=(rescan_interval,), daemon=True)
+            thread.start()
+    #:
+
+    def rescan(self):
+        """
+        Rebuilds the index from the backend. Lookups use the old index
+        until the new one is complete, and files uploaded meanwhile are
+        kept in the new one.
+        """
+        with self._rescan_lock:
+            with self._lock:
+                self._added = {}
+            try:
+                files = {entry.name: entry for entry in self.backend.list()}
+            except BaseException:
+                with self._lock:
+                    self._added = None
+                raise
+            with self._lock:
+                files.update(self._added)
+                self._added = None
+                folded = {}
+                for name in sorted(files):
+                    folded.setdefault(name.lower(), name)
+                self._files, self._folded = files, folded
+    #:
+
+    def _rescan_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.rescan()
+            except OSError:
+                pass
+    #:
+
+    def close(self):
+        self._stop.set()
+    #:
+
+    def resolve(self, name: str) -> str:
+        """
+        Returns the indexed name matching name. Raises FileNotFoundError
+        if there is none, or PermissionError if name leaves the tree.
+        """
+        norm_name = normalize_name(name)
+        if norm_name in self._files:
+            return norm_name
+        if self.ignore_case:
+            folded_name = self._folded.get(norm_name.lower())
+            if folded_name is not None:
+                return folded_name
+        raise FileNotFoundError(f"'{name}': file not found.")
+    #:
+
+    def stat(self, name: str) -> FileInfo:
+        return self._files[self.resolve(name)]
+    #:
+
+    def open_read(self, name: str) -> BinaryIO:
+        return self.backend.open_read(self.resolve(name))
+    #:
+
+    def open_write(self, name: str) -> Upload:
+        norm_name = normalize_name(name)
+        if self.ignore_case and norm_name.lower() in self._folded:
+            raise FileExistsError(f"'{name}': file already exists.")
+        return _IndexedUpload(self, norm_name, self.backend.open_write(norm_name))
+    #:
+
+    def list(self) -> List[FileInfo]:
+        return list(self._files.values())
+    #:
+
+    def _add(self, name: str):
+        try:
+            entry = self.backend.stat(name)
+        except OSError:
+            return
+        with self._lock:
+            self._files[entry.name] = entry
+            self._folded.setdefault(entry.name.lower(), entry.name)
+            if self._added is not None:
+                self._added[entry.name] = entry
+    #:
+#:
+
+class _IndexedUpload(Upload):
+    """
+    An upload through an IndexedStorage. Adds the file to the index once
+    committed.
+    """
+    def __init__(self, storage: IndexedStorage, name: str, upload: Upload):
+        super().__init__()
+        self._storage = storage
+        self._name = name
+        self._upload = upload
+    #:
+
+    def write(self, data: bytes) -> int:
+        return self._upload.write(data)
+    #:
+
+    def commit(self):
+        self._upload.commit()
+        self._storage._add(self._name)
+        super().commit()
+    #:
+
+    def abort(self):
+        self._upload.abort()
+        super().abort()
+    #:
+#:
+
+def open_storage(path: str) -> Storage:
+    """
+    Returns the storage backend for path: a DirectoryStorage if it is
+    a directory, an ArchiveStorage if it is a zip or tar file.
+    """
+    if os.path.isdir(path):
+        return DirectoryStorage(path)
+    if os.path.isfile(path):
+        return ArchiveStorage(path)
+    raise ValueError(f"'{path}': no such directory or archive.")
+#:
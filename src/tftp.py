@@ -22,7 +22,12 @@ import ipaddress
 import socket 
 from typing import Tuple
 import os
+import io
 import random
+import logging
+import threading
+import time
+from contextlib import contextmanager
 ################################################################################
 ##
 ##      PROTOCOL CONSTANTS AND TYPES
@@ -31,6 +36,7 @@ import random
 
 MAX_DATA_LEN = 512            # bytes
 INACTIVITY_TIMEOUT = 30       # segs
+RETRANSMIT_TIMEOUT = 1        # segs without a reply before resending
 MAX_BLOCK_NUMBER = 2**16 - 1 
 DEFAULT_MODE = 'octet'
 SOCKET_BUFFER_SIZE = 8192     # bytes
@@ -73,272 +79,461 @@ ERROR_MSGS = {
 INET4Address = Tuple[str, int]        # TCP/UDP address => IPv4 and port
 # FileReference = Union[str, BinaryIO]  # A path or a file object
 
+# Nothing is logged unless the application sets up logging (see tftplog)
+logger = logging.getLogger('tftp')
+logger.addHandler(logging.NullHandler())
+
 ###############################################################
 ##
 ##      SEND AND RECEIVE MESSAGES
 ##
 ###############################################################
 
-def get_file(serv_addr: INET4Address, file_name: str, new_file_name: str, serv_name):
+# Packet trace recorder (see the tracing module); None disables tracing
+tracer = None
+
+def set_tracer(recorder):
     """
-    RRQ a file given by filename from a remote TFTP server given
-    by serv_addr.
+    Records every packet sent or received by the transfer functions
+    with recorder, a tracing.TraceRecorder. None stops recording.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        with open(new_file_name, 'wb') as file:
-            sock.settimeout(INACTIVITY_TIMEOUT)
-            rrq = pack_rrq(file_name)
-            try:
-                sock.sendto(rrq, serv_addr)
-            except:
-                raise NetworkError(f"Error reaching the server '{serv_name}' ({serv_addr[0]}).")           
-            next_block_num = 1
-            tot_data = 0
-            while True:
-                packet, new_serv_addr = sock.recvfrom(SOCKET_BUFFER_SIZE)
-                opcode = unpack_opcode(packet)
-                    
-                if opcode == DAT:
-                    block_num, data = unpack_dat(packet)
-                    if block_num != next_block_num:
-                        raise ProtocolError(f"Invalid block number {block_num}")
+    global tracer
+    tracer = recorder
+#:
+
+# Per-phase timing of the transfer run by each thread (see the profiling module)
+_timing = threading.local()
+
+def set_phase_timer(timer):
+    """
+    Adds the time spent in each phase (read, pack, send, recv, write)
+    of the transfers run by the calling thread to timer, a
+    profiling.PhaseTimer. None stops timing.
+    """
+    _timing.timer = timer
+#:
+
+def _timed(phase: str, func, *args):
+    timer = getattr(_timing, 'timer', None)
+    if timer is None:
+        return func(*args)
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timer.add(phase, time.perf_counter() - start)
+#:
 
-                    file.write(data)
-                    tot_data += len(data)
+def make_socket() -> socket.socket:
+    """
+    Returns the UDP socket used by a transfer. Replaced by the tracing
+    module to replay recorded transfers.
+    """
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+#:
 
-                    ack = pack_ack(next_block_num)
-                    sock.sendto(ack, new_serv_addr)
+def _sendto(sock, packet: bytes, addr: INET4Address):
+    _timed('send', sock.sendto, packet, addr)
+    if tracer is not None:
+        tracer.record_out(sock, packet)
+#:
 
-                    if len(data) < MAX_DATA_LEN:
-                        break
+def _recvfrom(sock) -> Tuple[bytes, INET4Address]:
+    packet, addr = _timed('recv', sock.recvfrom, SOCKET_BUFFER_SIZE)
+    if tracer is not None:
+        tracer.record_in(sock, packet)
+    return packet, addr
+#:
 
-                elif opcode == ERR:
-                    raise Err(*unpack_err(packet))
+class TransferCounter:
+    """
+    Bytes sent or received so far by a *_resp function, and the packets
+    it sent again (see _recv_block). Updated after every block, so it
+    still holds the counts if the transfer fails.
+    """
+    def __init__(self):
+        self.bytes = 0
+        self.retransmits = 0
+    #:
+#:
 
-                else: # opcode not in (DAT, ERR):
-                    raise ProtocolError(f'Invalid opcode {opcode}')
+def _recv_block(sock, last_packet: bytes, dest_addr: INET4Address, peer_addr, opcode: int,
+                block_num: int, timeout: float, retransmit: float,
+                counter: TransferCounter = None) -> Tuple[bytes, INET4Address]:
+    """
+    Waits for the opcode packet (DAT or ACK) numbered block_num from
+    peer_addr, or from any address if peer_addr is None (the reply to a
+    request comes from the TID of the server). Returns the packet and
+    its address. last_packet, the packet being answered, is sent again
+    to dest_addr every retransmit secs without a reply, until timeout
+    secs have passed. An earlier block means that a packet was lost or
+    duplicated on the way: a repeated DAT is answered by resending
+    last_packet, its ACK, while a repeated ACK is ignored, as resending
+    on it would double every packet from then on. Packets from other
+    addresses get an UNKNOWN_TRANSFER_ID error. A malformed or
+    unexpected packet ends the transfer with an ILLEGAL_OPERATION error. Resends are counted in
+    counter, if given.
+    """
+    interval = min(retransmit, timeout)
+    sock.settimeout(interval)
+    waited = 0.0
+    while True:
+        try:
+            packet, addr = _recvfrom(sock)
+        except socket.timeout:
+            waited += interval
+            if waited >= timeout:
+                raise
+            _resend(sock, last_packet, dest_addr, counter)
+            continue
+        if peer_addr is not None and addr != peer_addr:
+            _sendto(sock, pack_err(UNKNOWN_TRANSFER_ID), addr)
+            continue
 
-                next_block_num += 1
-            return tot_data
+        try:
+            recv_opcode = unpack_opcode(packet)
+            if recv_opcode == ERR:
+                raise Err(*unpack_err(packet))
+            if recv_opcode != opcode:
+                raise ValueError(f'Invalid opcode {recv_opcode}')
+            recv_block_num = unpack_dat(packet)[0] if opcode == DAT else unpack_ack(packet)
+        except ValueError as ex:
+            _sendto(sock, pack_err(ILLEGAL_OPERATION), addr)
+            raise ProtocolError(str(ex))
+        if recv_block_num == block_num:
+            return packet, addr
+        behind = (block_num - recv_block_num) & MAX_BLOCK_NUMBER
+        if behind > MAX_BLOCK_NUMBER // 2:
+            raise ProtocolError(f'Invalid block number {recv_block_num}')
+        if opcode == DAT and behind == 1:
+            _resend(sock, last_packet, dest_addr, counter)
+    #:
+#:
+
+def _resend(sock, packet: bytes, addr: INET4Address, counter: TransferCounter = None):
+    _sendto(sock, packet, addr)
+    if counter is not None:
+        counter.retransmits += 1
+#:
+
+def iter_get(serv_addr: INET4Address, file_name: str, serv_name='',
+             timeout: float = INACTIVITY_TIMEOUT, retransmit: float = RETRANSMIT_TIMEOUT):
+    """
+    RRQ a file given by file_name from a remote TFTP server given
+    by serv_addr, yielding each data block as soon as it arrives.
+    The ACK for a block is only sent when the consumer asks for the
+    next one, so a slow consumer slows down the server instead of
+    piling data up in memory. The last block is acknowledged before
+    it is yielded. Closing the generator before the end cancels the
+    transfer with an error to the server. Lost packets are sent again
+    every retransmit secs; the transfer fails with socket.timeout after
+    timeout secs without the next block.
+    """
+    with make_socket() as sock:
+        packet = pack_rrq(file_name)
+        try:
+            _sendto(sock, packet, serv_addr)
+        except:
+            raise NetworkError(f"Error reaching the server '{serv_name}' ({serv_addr[0]}).")
+        dest_addr, new_serv_addr = serv_addr, None
+        next_block_num = 1
+        while True:
+            dat, new_serv_addr = _recv_block(sock, packet, dest_addr, new_serv_addr, DAT,
+                                             next_block_num, timeout, retransmit)
+            dest_addr = new_serv_addr
+            _, data = unpack_dat(dat)
+
+            packet = _timed('pack', pack_ack, next_block_num)
+            if len(data) < MAX_DATA_LEN:
+                # ACK the last block before handing it over: the consumer
+                # may stop asking for more once it sees a short block
+                _sendto(sock, packet, new_serv_addr)
+                yield data
+                break
+
+            try:
+                yield data
+            except GeneratorExit:
+                # The consumer stopped early: tell the server, which would
+                # otherwise resend the block until its timeout
+                try:
+                    _sendto(sock, pack_err(UNDEF_ERROR, 'Transfer cancelled'), new_serv_addr)
+                except OSError:
+                    pass
+                raise
+            _sendto(sock, packet, new_serv_addr)
+            next_block_num = (next_block_num + 1) & MAX_BLOCK_NUMBER
         #:
     #:
 #:
 
-##################################################################################
-def dir_req(serv_addr: INET4Address):
+def get_to(serv_addr: INET4Address, file_name: str, file, serv_name='',
+           timeout: float = INACTIVITY_TIMEOUT, retransmit: float = RETRANSMIT_TIMEOUT) -> int:
+    """
+    RRQ a file given by file_name from a remote TFTP server given
+    by serv_addr and write its contents to file, which may be any
+    binary file object (a regular file, a pipe, io.BytesIO, or
+    sock.makefile('wb') for a socket). Returns the number of bytes
+    received. See iter_get for timeout and retransmit.
+    """
+    tot_data = 0
+    for data in iter_get(serv_addr, file_name, serv_name, timeout, retransmit):
+        _timed('write', file.write, data)
+        tot_data += len(data)
+    return tot_data
+#:
+
+def get_file(serv_addr: INET4Address, file_name: str, new_file_name: str, serv_name):
     """
     RRQ a file given by filename from a remote TFTP server given
     by serv_addr.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.settimeout(INACTIVITY_TIMEOUT)
-        rrq = pack_rrq("")
-        file = b""
+    with open(new_file_name, 'wb') as file:
+        return get_to(serv_addr, file_name, file, serv_name)
+    #:
+#:
+
+##################################################################################
+def dir_req(serv_addr: INET4Address, file=None):
+    """
+    Requests a listing of the remote files from the TFTP server given
+    by serv_addr. The listing is printed, or written to the binary
+    file object file if one is given.
+    """
+    if file is not None:
+        return get_to(serv_addr, "", file)
+    listing = io.BytesIO()
+    tot_data = get_to(serv_addr, "", listing)
+    print(listing.getvalue().decode())
+    return tot_data
+#:
+###################################################################################################
+def iter_blocks(source, block_size: int = MAX_DATA_LEN):
+    """
+    Splits source into TFTP data blocks. source may be a binary file
+    object (anything with a read method) or an iterable of bytes-like
+    chunks of any size. Every block has block_size bytes except the
+    last one, which is shorter and may be empty, as the protocol
+    requires. Only about one block plus one chunk is kept in memory.
+    """
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: _timed('read', source.read, block_size), b'')
+    else:
+        chunks = source
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    yield bytes(buffer)
+#:
+
+def put_from(serv_addr: INET4Address, source, new_file_name: str, serv_name='',
+             timeout: float = INACTIVITY_TIMEOUT, retransmit: float = RETRANSMIT_TIMEOUT) -> int:
+    """
+    WRQ a file named new_file_name to a remote TFTP server given by
+    serv_addr, taking its contents from source (see iter_blocks). The
+    source is only read when the previous block has been acknowledged.
+    Returns the number of bytes sent. See iter_get for timeout and
+    retransmit.
+    """
+    with make_socket() as sock:
+        packet = pack_wrq(new_file_name)
         try:
-            sock.sendto(rrq, serv_addr)
+            _sendto(sock, packet, serv_addr)
         except:
-            raise NetworkError(f"Error reaching the server {serv_addr[0]}'.")           
-        next_block_num = 1
+            raise NetworkError(f"Error reaching the server '{serv_name}' ({serv_addr[0]}).")
+        dest_addr, new_serv_addr = serv_addr, None
+        blocks = iter_blocks(source)
+        next_block_num = 0      # the WRQ itself is acknowledged with block 0
         tot_data = 0
+        last_block = False
         while True:
-            packet, new_serv_addr = sock.recvfrom(SOCKET_BUFFER_SIZE)
-            opcode = unpack_opcode(packet)
-                
-            if opcode == DAT:
-                block_num, data = unpack_dat(packet)
-                if block_num != next_block_num:
-                    raise ProtocolError(f"Invalid block number {block_num}")
-                file += data
-                tot_data += len(data)
-                ack = pack_ack(next_block_num)
-                sock.sendto(ack, new_serv_addr)
-                if len(data) < MAX_DATA_LEN:
-                    break
-            elif opcode == ERR:
-                raise Err(*unpack_err(packet))
-            else: # opcode not in (DAT, ERR):
-                raise ProtocolError(f'Invalid opcode {opcode}')
-            next_block_num += 1
-        print(file.decode())
+            _, new_serv_addr = _recv_block(sock, packet, dest_addr, new_serv_addr, ACK,
+                                           next_block_num, timeout, retransmit)
+            dest_addr = new_serv_addr
+            if last_block:
+                break
+
+            data = next(blocks)
+            next_block_num = (next_block_num + 1) & MAX_BLOCK_NUMBER
+            packet = _timed('pack', pack_dat, next_block_num, data)
+            _sendto(sock, packet, new_serv_addr)
+            tot_data += len(data)
+            last_block = len(data) < MAX_DATA_LEN
         return tot_data
-        #:
     #:
 #:
-###################################################################################################
-def iter_bytes(my_bytes):
-    for i in range(len(my_bytes)):
-        yield my_bytes[i:i+1]
 
 def put_file(serv_addr: INET4Address, file_name: str, new_file_name: str, serv_name='' ):
     """
     WRQ a file given by filename to a remote TFTP server given
     by serv_addr.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        with open(file_name, 'rb') as file:
-            sock.settimeout(INACTIVITY_TIMEOUT)
-            wrq = pack_wrq(new_file_name)
-            try:
-                sock.sendto(wrq, serv_addr)
-            except:
-                raise NetworkError(f"Error reaching the server '{serv_name}' ({serv_addr[0]}).")           
-            next_block_num = 1
-            read_file = file.read()
-            iter_file_cont = iter_bytes(read_file)    
-            _supra_state_ = 1
-            tot_data = 0
-            while _supra_state_ == 1:
-                packet, new_serv_addr = sock.recvfrom(SOCKET_BUFFER_SIZE)
-                opcode = unpack_opcode(packet)
-                
-                if opcode == ACK:
-                    block_num = unpack_ack(packet)
-                    if block_num + 1 != next_block_num:
-                        raise ProtocolError(f'Invalid block number {block_num}')
-
-                    _sub_state_ = 1
-                    data = b''
-                    while _sub_state_ == 1:
-                        try:
-                            if len(data) < 512:
-                                w = next(iter_file_cont)
-                                data += w
-                                tot_data += 1
-
-                            else:
-                                dat = pack_dat(next_block_num, data)
-                                sock.sendto(dat, new_serv_addr)
-                                _sub_state_= 0
-                       
-                        except StopIteration:
-                            dat = pack_dat(next_block_num, data)
-                            sock.sendto(dat, new_serv_addr)
-                            _sub_state_= 0
-                            _supra_state_= 0
-                                                  
-                    
-                next_block_num += 1
-            return tot_data
+    with open(file_name, 'rb') as file:
+        return put_from(serv_addr, file, new_file_name, serv_name)
+    #:
+#:
 
 ######################################################################################################
-def get_resp(client_addr, file_name):
+def _send_blocks(sock, client_addr: INET4Address, blocks, timeout: float, retransmit: float,
+                 counter: TransferCounter = None) -> int:
     """
-    RRQ request server response.
+    Sends each data block in blocks to client_addr, waiting for its ACK
+    before reading the next one. Returns the number of bytes sent.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-        sock.bind((client_addr[0],random.randrange(49152,65535)))
+    next_block_num = 1
+    tot_data = 0
+    with _report_errors(sock, client_addr):
+        for data in blocks:
+            dat = _timed('pack', pack_dat, next_block_num, data)
+            _sendto(sock, dat, client_addr)
+            tot_data += len(data)
+            if counter is not None:
+                counter.bytes += len(data)
+            _recv_block(sock, dat, client_addr, client_addr, ACK, next_block_num, timeout, retransmit,
+                        counter)
+            next_block_num = (next_block_num + 1) & MAX_BLOCK_NUMBER
+    return tot_data
+#:
+
+def error_code(ex: Exception) -> int:
+    """
+    Returns the TFTP error code matching a storage exception.
+    """
+    if isinstance(ex, FileNotFoundError):
+        return FILE_NOT_FOUND
+    if isinstance(ex, FileExistsError):
+        return FILE_EXISTS
+    if isinstance(ex, PermissionError):
+        return ACCESS_VIOLATION
+    return UNDEF_ERROR
+#:
+
+@contextmanager
+def _report_errors(sock, client_addr: INET4Address):
+    """
+    Sends client_addr the ERR matching a local failure (e.g. reading or
+    writing the file) that ends a server side transfer, so that the
+    client doesn't wait for its timeout. Timeouts and errors that come
+    from the client, or were already reported to it, pass through.
+    """
+    try:
+        yield
+    except (socket.timeout, NetworkError, Err):
+        raise
+    except (OSError, ValueError) as ex:
+        try:
+            _sendto(sock, pack_err(error_code(ex)), client_addr)
+        except OSError:
+            pass
+        raise
+#:
+
+def get_resp(client_addr, file_name, file=None, timeout: float = INACTIVITY_TIMEOUT,
+             retransmit: float = RETRANSMIT_TIMEOUT, counter: TransferCounter = None):
+    """
+    RRQ request server response. The file contents are read from file,
+    a binary file object, or from the local file file_name if no file
+    is given. See iter_get for timeout and retransmit, and
+    TransferCounter for counter.
+    """
+    if file is None:
         with open(file_name, 'rb') as file:
-            sock.settimeout(INACTIVITY_TIMEOUT)
-            next_block_num = 1
-            read_file = file.read()
-            iter_file_cont = iter_bytes(read_file)    
-            data = b''
-            tot_data = 0
-            _supra_state_ = 2
-            while _supra_state_ == 2:
-                try:
-                    if len(data) < 512:
-                        w = next(iter_file_cont)
-                        data += w
-                        tot_data += 1
-                    else:
-                        dat = pack_dat(next_block_num, data)
-                        sock.sendto(dat, client_addr)
-                        _sub_state_= 1
-                        _supra_state_ = 1
-                except StopIteration:
-                    dat = pack_dat(next_block_num, data)
-                    sock.sendto(dat, client_addr)
-                    _sub_state_= 1
-                    _supra_state_= 1
-            next_block_num += 1
-            while _supra_state_ == 1:
-                packet, client_addr = sock.recvfrom(SOCKET_BUFFER_SIZE)
-                opcode = unpack_opcode(packet)
-                if opcode == ACK:
-                    block_num = unpack_ack(packet)
-                    if block_num + 1 != next_block_num:
-                        raise ProtocolError(f'Invalid block number {block_num}')
-                    _sub_state_ = 1
-                    data = b''
-                    while _sub_state_ == 1:
-                        try:
-                            if len(data) < 512:
-                                w = next(iter_file_cont)
-                                data += w
-                                tot_data += 1
-                            else:
-                                dat = pack_dat(next_block_num, data)
-                                sock.sendto(dat, client_addr)
-                                _sub_state_= 0
-                        except StopIteration:
-                            dat = pack_dat(next_block_num, data)
-                            sock.sendto(dat, client_addr)
-                            _sub_state_= 0
-                            _supra_state_= 0
-                next_block_num += 1
-            print(f"'{file_name}': file sent")
-            return tot_data
+            return get_resp(client_addr, file_name, file, timeout, retransmit, counter)
+    with make_socket() as sock:
+        sock.bind((client_addr[0],random.randrange(49152,65535)))
+        tot_data = _send_blocks(sock, client_addr, iter_blocks(file), timeout, retransmit, counter)
+    logger.debug("'%s': file sent", file_name)
+    return tot_data
+#:
 
 ######################################################################################################
-def dir_resp(client_addr, file_name):
+def put_resp(client_addr, file_name, file, timeout: float = INACTIVITY_TIMEOUT,
+             retransmit: float = RETRANSMIT_TIMEOUT, on_complete=None,
+             counter: TransferCounter = None):
     """
-    DIR request server response.
+    WRQ request server response. The received data is written to file,
+    a binary file object. on_complete, if given, is called once the
+    last block is written and before it is acknowledged, e.g. to commit
+    a storage.Upload. The last ACK may be lost, so the last block is
+    acknowledged again if the client resends it within retransmit secs;
+    this runs in a background thread that owns the socket, so the
+    transfer is over for the caller as soon as the last ACK is sent.
+    See iter_get for timeout and retransmit, and TransferCounter for
+    counter.
     """
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    sock = make_socket()
+    try:
         sock.bind((client_addr[0],random.randrange(49152,65535)))
-        file = os.popen(f"ls -l").read().encode()
-        print(file)
-        sock.settimeout(INACTIVITY_TIMEOUT)
+        ack = pack_ack(0)
+        _sendto(sock, ack, client_addr)
         next_block_num = 1
-        iter_file_cont = iter_bytes(file)    
-        data = b''
         tot_data = 0
-        _supra_state_ = 2
-        while _supra_state_ == 2:
-            try:
-                if len(data) < 512:
-                    w = next(iter_file_cont)
-                    data += w
-                    tot_data += 1
-                else:
-                    dat = pack_dat(next_block_num, data)
-                    sock.sendto(dat, client_addr)
-                    _sub_state_= 1
-                    _supra_state_ = 1
-            except StopIteration:
-                dat = pack_dat(next_block_num, data)
-                sock.sendto(dat, client_addr)
-                _sub_state_= 1
-                _supra_state_= 1
-        next_block_num += 1
-        while _supra_state_ == 1:
-            packet, client_addr = sock.recvfrom(SOCKET_BUFFER_SIZE)
-            opcode = unpack_opcode(packet)
-            if opcode == ACK:
-                block_num = unpack_ack(packet)
-                if block_num + 1 != next_block_num:
-                    raise ProtocolError(f'Invalid block number {block_num}')
-                _sub_state_ = 1
-                data = b''
-                while _sub_state_ == 1:
-                    try:
-                        if len(data) < 512:
-                            w = next(iter_file_cont)
-                            data += w
-                            tot_data += 1
-                        else:
-                            dat = pack_dat(next_block_num, data)
-                            sock.sendto(dat, client_addr)
-                            _sub_state_= 0
-                    except StopIteration:
-                        dat = pack_dat(next_block_num, data)
-                        sock.sendto(dat, client_addr)
-                        _sub_state_= 0
-                        _supra_state_= 0
-            next_block_num += 1
-        print(f"'{file_name}': file sent")
-        return tot_data#####################################################################################################################
+        with _report_errors(sock, client_addr):
+            while True:
+                dat, _ = _recv_block(sock, ack, client_addr, client_addr, DAT,
+                                     next_block_num, timeout, retransmit, counter)
+                _, data = unpack_dat(dat)
+                _timed('write', file.write, data)
+                tot_data += len(data)
+                if counter is not None:
+                    counter.bytes += len(data)
+
+                last_block = len(data) < MAX_DATA_LEN
+                if last_block and on_complete is not None:
+                    on_complete()
+                ack = _timed('pack', pack_ack, next_block_num)
+                _sendto(sock, ack, client_addr)
+                if last_block:
+                    break
+                next_block_num = (next_block_num + 1) & MAX_BLOCK_NUMBER
+    except BaseException:
+        sock.close()
+        raise
+    threading.Thread(target=_dally, args=(sock, ack, client_addr, dat, retransmit), daemon=True).start()
+    logger.debug("'%s': file received", file_name)
+    return tot_data
+#:
+
+def _dally(sock, ack: bytes, client_addr: INET4Address, last_dat: bytes, retransmit: float):
+    """
+    Resends the last ACK each time the client resends the last DAT,
+    because the ACK was lost, until retransmit secs pass without it.
+    Closes sock when done.
+    """
+    with sock:
+        sock.settimeout(retransmit)
+        try:
+            while True:
+                packet, addr = _recvfrom(sock)
+                if addr == client_addr and packet == last_dat:
+                    _sendto(sock, ack, client_addr)
+        except OSError:
+            pass
+    #:
+#:
+
+######################################################################################################
+def dir_resp(client_addr, file_name, listing: bytes = None, timeout: float = INACTIVITY_TIMEOUT,
+             retransmit: float = RETRANSMIT_TIMEOUT, counter: TransferCounter = None):
+    """
+    DIR request server response. Sends listing, or the output of
+    'ls -l' on the current directory if no listing is given. See
+    iter_get for timeout and retransmit, and TransferCounter for
+    counter.
+    """
+    if listing is None:
+        listing = os.popen(f"ls -l").read().encode()
+    logger.debug('DIR listing of %d bytes', len(listing))
+    with make_socket() as sock:
+        sock.bind((client_addr[0],random.randrange(49152,65535)))
+        tot_data = _send_blocks(sock, client_addr, iter_blocks([listing]), timeout, retransmit, counter)
+    logger.debug('DIR listing sent')
+    return tot_data
+#:
+
 ################################################################################
 ##
 ##      PACKET PACKING AND UNPACKING
@@ -395,6 +590,8 @@ def pack_dat(block_number: int, data: bytes) -> bytes:
 #:
 
 def unpack_dat(packet: bytes) -> Tuple[int, bytes]:
+    if len(packet) < 4:
+        raise ValueError(f'Invalid packet length: {len(packet)}')
     _, block_number = struct.unpack('!HH', packet[:4])
     return block_number, packet[4:]
 #:
@@ -406,19 +603,30 @@ def pack_ack(block_number: int) -> bytes:
 #:
 
 def unpack_ack(packet: bytes) -> int:
-    if len(packet) > 4:
+    if len(packet) != 4:
         raise ValueError(f'Invalid packet length: {len(packet)}')
     return struct.unpack('!H', packet[2:4])[0]
 #:
 
 def unpack_opcode(packet: bytes) -> int:
+    if len(packet) < 2:
+        raise ValueError(f'Invalid packet length: {len(packet)}')
     opcode, *_ = struct.unpack("!H", packet[:2])
     if opcode not in (RRQ, WRQ, DAT, ACK, ERR):
         raise ValueError(f'Unrecognized opcode {opcode}.')
     return opcode
 #:
 
+def pack_err(error_code: int, error_msg: str = None) -> bytes:
+    if error_msg is None:
+        error_msg = ERROR_MSGS.get(error_code, ERROR_MSGS[UNDEF_ERROR]).rstrip('.')
+    pack_msg = error_msg.encode() + b'\x00'
+    return struct.pack(f'!HH{len(pack_msg)}s', ERR, error_code, pack_msg)
+#:
+
 def unpack_err(packet: bytes) -> Tuple[int, str]:
+    if len(packet) < 4:
+        raise ValueError(f'Invalid packet length: {len(packet)}')
     _, error_num, error_msg = struct.unpack(f'!HH{len(packet)-4}s', packet)
     return error_num, error_msg[:-1]
 #:
@@ -0,0 +1,193 @@
+"""
+tftplog module - logging setup for the TFTP server and the transfer
+functions.
+
+Records are put in a bounded queue by the thread that logs them and
+written by a background thread, so a slow terminal or pipe never
+blocks a transfer; when the queue is full records are dropped and
+counted instead, and the count is written with the next record. Repetitive messages are rate limited per message
+template, except for the transfer summaries of log_transfer, and each
+record is written with its extra fields as key=value pairs, e.g.:
+
+    2022-07-01 10:00:00,000 INFO tftp.server: transfer operation=get client=10.0.0.2:5001 file=boot.img bytes=52430 duration=0.108 retransmits=0
+"""
+
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOGGER_NAME = 'tftp'
+QUEUE_SIZE = 10000            # records
+RATE_LIMIT = 20               # records with the same template...
+RATE_INTERVAL = 1.0           # ...per interval (secs)
+# Records with this extra field set are never rate limited
+NO_RATE_LIMIT = 'no_rate_limit'
+
+# Attributes every LogRecord has, and extra fields that aren't written
+_RECORD_ATTRS = (set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__)
+                 | {'message', 'asctime', NO_RATE_LIMIT})
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Appends the extra fields of a record to the formatted message, as
+    key=value pairs. Values with spaces are quoted.
+    """
+    def __init__(self, fmt='%(asctime)s %(levelname)s %(name)s: %(message)s'):
+        super().__init__(fmt)
+    #:
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = [f'{key}={_quote(value)}' for key, value in record.__dict__.items()
+                  if key not in _RECORD_ATTRS]
+        return ' '.join([line, *fields]) if fields else line
+    #:
+#:
+
+def _quote(value) -> str:
+    text = str(value)
+    return repr(text) if not text or ' ' in text else text
+#:
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most rate records with the same logger and message template
+    through in each interval (secs). The first record let through after
+    some were dropped carries their number in its 'suppressed' field.
+    Records with the NO_RATE_LIMIT extra field set always go through.
+    """
+    def __init__(self, rate: int = RATE_LIMIT, interval: float = RATE_INTERVAL):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self._windows = {}    # (logger, template) => [window start, count, suppressed]
+        self._lock = threading.Lock()
+    #:
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, NO_RATE_LIMIT, False):
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self._windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            window[1] += 1
+            if window[1] > self.rate:
+                window[2] += 1
+                return False
+        return True
+    #:
+#:
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that never blocks: records that don't fit in the
+    queue are dropped and counted in 'dropped'. The first record queued
+    after some were dropped carries their number in its 'dropped' field.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.unreported = 0   # dropped since the last 'dropped' field
+    #:
+
+    def enqueue(self, record: logging.LogRecord):
+        # Called with the handler lock held
+        if self.unreported:
+            record.dropped = self.unreported
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+        else:
+            self.unreported = 0
+    #:
+#:
+
+class _DropReportingListener(logging.handlers.QueueListener):
+    """
+    A QueueListener that, when stopped, writes a record with the number
+    of records its DroppingQueueHandler dropped since the last report.
+    """
+    def __init__(self, log_queue: queue.Queue, queue_handler: DroppingQueueHandler,
+                 handler: logging.Handler):
+        super().__init__(log_queue, handler, respect_handler_level=True)
+        self.queue_handler = queue_handler
+    #:
+
+    def enqueue_sentinel(self):
+        # The queue may be full: wait for the thread to make room
+        self.queue.put(self._sentinel)
+    #:
+
+    def stop(self):
+        super().stop()
+        with self.queue_handler.lock:
+            dropped, self.queue_handler.unreported = self.queue_handler.unreported, 0
+        if dropped:
+            record = logging.getLogger(LOGGER_NAME).makeRecord(
+                LOGGER_NAME, logging.WARNING, __file__, 0, 'log records dropped', (), None,
+                extra={'dropped': dropped})
+            self.handle(record)
+    #:
+#:
+
+def setup_logging(level='INFO', handler: logging.Handler = None,
+                  rate: int = RATE_LIMIT, interval: float = RATE_INTERVAL) -> logging.handlers.QueueListener:
+    """
+    Sends the records of the 'tftp' loggers with at least level to
+    handler (stderr by default) through a background thread. Returns
+    the started QueueListener; call its stop method before exiting to
+    write the queued records and the number of records dropped since
+    the last one was queued.
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+    if handler.formatter is None:
+        handler.setFormatter(StructuredFormatter())
+    log_queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate, interval))
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    listener = _DropReportingListener(log_queue, queue_handler, handler)
+    listener.start()
+    return listener
+#:
+
+def log_transfer(logger: logging.Logger, operation: str, client_addr, file_name: str,
+                 tot_data: int, duration: float, error: str = '', retransmits: int = 0,
+                 **timings: float):
+    """
+    Logs the summary record of a transfer: a 'transfer' record at INFO
+    level, or a 'transfer failed' record at WARNING level if error is
+    given. retransmits is the number of packets sent again. timings
+    (secs) are added to the record as extra fields.
+    Summaries are never rate limited: there is one per transfer.
+    """
+    fields = {
+        NO_RATE_LIMIT: True,
+        'operation': operation,
+        'client': f'{client_addr[0]}:{client_addr[1]}',
+        'file': file_name,
+        'bytes': tot_data,
+        'duration': round(duration, 6),
+        'retransmits': retransmits,
+    }
+    fields.update((name, round(secs, 6)) for name, secs in timings.items())
+    if error:
+        fields['error'] = error
+        logger.warning('transfer failed', extra=fields)
+    else:
+        logger.info('transfer', extra=fields)
+#:
@@ -0,0 +1,423 @@
+"""
+tracing module - records the packets of TFTP transfers to a compact
+binary trace, replays recorded transfers under a simulated clock and
+reports stalls, retransmissions and throughput.
+
+Usage:
+  tracing.py analyze [--stall=<secs>] [--interval=<secs>] <trace_file>
+  tracing.py replay <trace_file> [<transfer>]
+
+Options:
+-h --help           show help
+analyze             report stalls, retransmissions and throughput per transfer
+replay              re-drive the TFTP state machine of each recorded transfer
+--stall=<secs>      [default: 1.0] minimum gap between packets reported as a stall
+--interval=<secs>   [default: 1.0] width of the throughput buckets
+trace_file          trace written by a TraceRecorder
+transfer            replay only the transfer with this number
+
+A trace starts with TRACE_MAGIC followed by one fixed size record per
+packet (see RECORD_FORMAT). Every socket a transfer function opens is
+numbered by the recorder, and the records of its packets carry that
+transfer number along with the TID (the local UDP port). Transfers are
+grouped by number rather than by TID because ephemeral ports are reused.
+
+To record the transfers of a program:
+    tftp.set_tracer(tracing.TraceRecorder('transfers.trc'))
+"""
+
+import io
+import itertools
+import socket
+import struct
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Union
+
+import tftp
+
+TRACE_MAGIC = b'TFTPTRC2'
+RECORD_FORMAT = '!dBIHBHH'    # timestamp, direction, transfer, TID, opcode, block, length
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+FLUSH_SIZE = 64 * 1024        # bytes buffered before writing to the trace
+
+# Packet directions
+IN = 0
+OUT = 1
+
+class Record(NamedTuple):
+    timestamp: float          # seconds since the epoch
+    direction: int            # IN or OUT
+    transfer: int             # number of the transfer in the trace
+    tid: int                  # local port of the transfer
+    opcode: int
+    block: int                # block number, or error code for ERR
+    length: int               # whole packet length, in bytes
+#:
+
+################################################################################
+##
+##      RECORDING
+##
+################################################################################
+
+class TraceRecorder:
+    """
+    Writes a record per packet to file, a path or a binary file object.
+    Records are buffered in memory and written FLUSH_SIZE bytes at a
+    time, so recording costs a struct.pack per packet; the transfer
+    number and port of each socket are looked up once and cached. Safe
+    to share between the threads of the server.
+    """
+    def __init__(self, file: Union[str, BinaryIO]):
+        self._own_file = isinstance(file, str)
+        self._file = open(file, 'wb') if self._own_file else file
+        self._file.write(TRACE_MAGIC)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._sockets = weakref.WeakKeyDictionary()    # socket => (transfer, TID)
+        self._transfers = itertools.count(1)
+    #:
+
+    def record_in(self, sock, packet: bytes):
+        self._record(IN, sock, packet)
+    #:
+
+    def record_out(self, sock, packet: bytes):
+        self._record(OUT, sock, packet)
+    #:
+
+    def _record(self, direction: int, sock, packet: bytes):
+        if len(packet) >= 4:
+            opcode, block = struct.unpack_from('!HH', packet)
+            if opcode in (tftp.RRQ, tftp.WRQ):
+                block = 0
+        else:
+            opcode, block = 0, 0
+        ids = self._sockets.get(sock)
+        if ids is None:
+            with self._lock:
+                ids = self._sockets[sock] = (next(self._transfers), sock.getsockname()[1])
+        record = struct.pack(RECORD_FORMAT, time.time(), direction, *ids,
+                             opcode, block, len(packet))
+        with self._lock:
+            self._buffer += record
+            if len(self._buffer) >= FLUSH_SIZE:
+                self._flush()
+    #:
+
+    def _flush(self):
+        self._file.write(self._buffer)
+        self._buffer.clear()
+    #:
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+            self._file.flush()
+    #:
+
+    def close(self):
+        self.flush()
+        if self._own_file:
+            self._file.close()
+    #:
+
+    def __enter__(self):
+        return self
+    #:
+
+    def __exit__(self, *exc_info):
+        self.close()
+    #:
+#:
+
+def read_trace(file: Union[str, BinaryIO]) -> List[Record]:
+    """
+    Returns the records of the trace in file, a path or a binary file
+    object.
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as trace_file:
+            return read_trace(trace_file)
+    if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError('Not a TFTP packet trace.')
+    data = file.read()
+    data = data[:len(data) - len(data) % RECORD_SIZE]
+    return [Record(*fields) for fields in struct.iter_unpack(RECORD_FORMAT, data)]
+#:
+
+def split_transfers(records: Iterable[Record]) -> Dict[int, List[Record]]:
+    """
+    Groups records by transfer number, keeping their order.
+    """
+    transfers: Dict[int, List[Record]] = {}
+    for record in records:
+        transfers.setdefault(record.transfer, []).append(record)
+    return transfers
+#:
+
+################################################################################
+##
+##      REPLAY
+##
+################################################################################
+
+REPLAY_ADDR = ('127.0.0.1', 69)
+
+class ReplaySocket:
+    """
+    Stands for the UDP socket of a transfer during a replay. Received
+    packets are rebuilt from the IN records of the transfer (DAT payloads
+    are zero filled) and the simulated clock jumps to their timestamps.
+    Sent packets are checked against the OUT records. A receive times
+    out, as a real one would, if the next record is further away than
+    the socket timeout, and fails with ConnectionAbortedError at the end
+    of the trace.
+    """
+    def __init__(self, records: List[Record]):
+        self._records = records
+        self._pos = 0
+        self.clock = records[0].timestamp if records else 0.0
+        self.timeout = None
+        self.sent: List[Record] = []
+        self.mismatches: List[Record] = []
+        # Set by close(), which may come from another thread (see tftp.put_resp)
+        self.closed = threading.Event()
+    #:
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    #:
+
+    def bind(self, addr):
+        pass
+    #:
+
+    def getsockname(self):
+        return ('127.0.0.1', self._records[0].tid if self._records else 0)
+    #:
+
+    def sendto(self, packet: bytes, addr):
+        opcode, block = struct.unpack_from('!HH', packet)
+        if opcode in (tftp.RRQ, tftp.WRQ):
+            block = 0
+        sent = Record(self.clock, OUT, self._records[0].transfer, self.getsockname()[1],
+                      opcode, block, len(packet))
+        self.sent.append(sent)
+        expected = self._next(OUT)
+        if expected is not None and opcode in (tftp.RRQ, tftp.WRQ):
+            # the file name is not recorded, so the length can't match
+            expected = expected._replace(length=sent.length)
+        if expected is None or expected[1:] != sent[1:]:
+            self.mismatches.append(sent)
+    #:
+
+    def recvfrom(self, bufsize: int):
+        while self._pos < len(self._records):
+            record = self._records[self._pos]
+            if self.timeout is not None and record.timestamp - self.clock > self.timeout:
+                # The recording side timed out here (and, if the record is
+                # an OUT one, sent its last packet again)
+                self.clock += self.timeout
+                raise socket.timeout('timed out')
+            self._pos += 1
+            if record.direction == IN:
+                self.clock = max(self.clock, record.timestamp)
+                return rebuild_packet(record), REPLAY_ADDR
+            # OUT records left before the next IN record are packets the
+            # state machine did not send
+            self.mismatches.append(record)
+        # Not a timeout, which would only make the state machine retransmit
+        raise ConnectionAbortedError('end of trace')
+    #:
+
+    def _next(self, direction: int):
+        if self._pos < len(self._records) and self._records[self._pos].direction == direction:
+            self._pos += 1
+            return self._records[self._pos - 1]
+        return None
+    #:
+
+    def close(self):
+        self.closed.set()
+    #:
+
+    def __enter__(self):
+        return self
+    #:
+
+    def __exit__(self, *exc_info):
+        self.close()
+    #:
+#:
+
+def rebuild_packet(record: Record) -> bytes:
+    """
+    Returns a packet matching record. Payloads are zero filled.
+    """
+    if record.opcode == tftp.DAT:
+        return tftp.pack_dat(record.block, bytes(max(record.length - 4, 0)))
+    if record.opcode == tftp.ACK:
+        return tftp.pack_ack(record.block)
+    if record.opcode == tftp.ERR:
+        return tftp.pack_err(record.block)
+    return struct.pack('!HH', record.opcode, record.block)
+#:
+
+class ReplayResult(NamedTuple):
+    transfer: int
+    tid: int
+    role: str                 # 'get', 'put', 'get_resp' or 'put_resp'
+    duration: float           # simulated seconds
+    sent: List[Record]
+    mismatches: List[Record]
+    error: str                # exception that ended the replay, or ''
+#:
+
+@contextmanager
+def _replay_socket(sock: ReplaySocket) -> Iterator[ReplaySocket]:
+    make_socket, tracer = tftp.make_socket, tftp.tracer
+    tftp.make_socket, tftp.tracer = (lambda: sock), None
+    try:
+        yield sock
+    finally:
+        tftp.make_socket, tftp.tracer = make_socket, tracer
+#:
+
+def replay(records: List[Record]) -> ReplayResult:
+    """
+    Re-drives the state machine of the recorded transfer (records with
+    the same transfer number). The role of the recording side is deduced from its
+    first packet: a RRQ or WRQ for the client, a DAT or ACK 0 for the
+    server. Replays are not thread safe: they replace tftp.make_socket
+    while they run.
+    """
+    if not records:
+        raise ValueError('Empty transfer.')
+    out_records = [record for record in records if record.direction == OUT]
+    if not out_records:
+        raise ValueError(f'Transfer {records[0].transfer} has no sent packets.')
+    first = out_records[0]
+    out_dats = [record for record in out_records if record.opcode == tftp.DAT]
+    out_size = sum(record.length - 4 for prev, record in zip([None, *out_dats], out_dats)
+                   if prev is None or record.block != prev.block)
+    sock = ReplaySocket(records)
+    error = ''
+    with _replay_socket(sock):
+        try:
+            if first.opcode == tftp.RRQ:
+                role = 'get'
+                tftp.get_to(REPLAY_ADDR, 'replay', io.BytesIO())
+            elif first.opcode == tftp.WRQ:
+                role = 'put'
+                tftp.put_from(REPLAY_ADDR, [bytes(out_size)], 'replay')
+            elif first.opcode == tftp.DAT:
+                role = 'get_resp'
+                tftp.get_resp(REPLAY_ADDR, 'replay', io.BytesIO(bytes(out_size)))
+            elif first.opcode == tftp.ACK:
+                role = 'put_resp'
+                tftp.put_resp(REPLAY_ADDR, 'replay', io.BytesIO())
+            else:
+                raise ValueError(f'Cannot replay a transfer starting with opcode {first.opcode}.')
+        except (tftp.NetworkError, tftp.Err, OSError) as ex:
+            error = f'{type(ex).__name__}: {ex}'
+        # put_resp keeps using the socket in the background for a while
+        sock.closed.wait()
+    return ReplayResult(records[0].transfer, records[0].tid, role, sock.clock - records[0].timestamp,
+                        sock.sent, sock.mismatches, error)
+#:
+
+################################################################################
+##
+##      ANALYSIS
+##
+################################################################################
+
+class TransferStats(NamedTuple):
+    transfer: int
+    tid: int
+    start: float
+    duration: float           # seconds
+    data_bytes: int           # DAT payload bytes, without retransmissions
+    packets: int
+    retransmits: int          # repeated DAT or ACK packets
+    stalls: List[tuple]       # (offset from start, gap) for each stall
+    throughput: List[float]   # bytes/s in each interval since start
+#:
+
+def analyze(records: List[Record], stall: float = 1.0, interval: float = 1.0) -> TransferStats:
+    """
+    Computes the statistics of a single transfer (records with the same
+    transfer number).
+    """
+    start = records[0].timestamp
+    duration = records[-1].timestamp - start
+    latest = {}       # (direction, opcode) => latest new block number
+    data_bytes = 0
+    retransmits = 0
+    stalls = []
+    buckets = [0] * (int(duration / interval) + 1)
+    prev_time = start
+    for record in records:
+        gap = record.timestamp - prev_time
+        if gap >= stall:
+            stalls.append((prev_time - start, gap))
+        prev_time = record.timestamp
+
+        if record.opcode in (tftp.DAT, tftp.ACK):
+            # Block numbers wrap around, so a block is new only if it is
+            # ahead of the latest one, not if it has never been seen
+            key = (record.direction, record.opcode)
+            if key in latest and not _is_ahead(record.block, latest[key]):
+                retransmits += 1
+                continue
+            latest[key] = record.block
+        if record.opcode == tftp.DAT:
+            data_bytes += record.length - 4
+            buckets[int((record.timestamp - start) / interval)] += record.length - 4
+    throughput = [data / interval for data in buckets]
+    return TransferStats(records[0].transfer, records[0].tid, start, duration, data_bytes, len(records),
+                         retransmits, stalls, throughput)
+#:
+
+def _is_ahead(block: int, latest: int) -> bool:
+    return 0 < (block - latest) & tftp.MAX_BLOCK_NUMBER <= tftp.MAX_BLOCK_NUMBER // 2
+#:
+
+def format_stats(stats: TransferStats) -> str:
+    rate = stats.data_bytes / stats.duration if stats.duration else 0.0
+    start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats.start))
+    lines = [
+        f'Transfer {stats.transfer} (TID {stats.tid}, {start})',
+        f'  {stats.data_bytes} bytes in {stats.duration:.3f} s ({rate:.0f} bytes/s), '
+        f'{stats.packets} packets, {stats.retransmits} retransmitted',
+    ]
+    for offset, gap in stats.stalls:
+        lines.append(f'  stall of {gap:.3f} s at +{offset:.3f} s')
+    lines.append('  throughput (bytes/s): ' + ' '.join(f'{rate:.0f}' for rate in stats.throughput))
+    return '\n'.join(lines)
+#:
+
+def format_replay(result: ReplayResult) -> str:
+    status = result.error or 'completed'
+    return (f'Transfer {result.transfer} (TID {result.tid}, {result.role}): {status}, {len(result.sent)} packets sent '
+            f'in {result.duration:.3f} simulated s, {len(result.mismatches)} differ from the trace')
+#:
+
+if __name__ == '__main__':
+    import docopt
+    args = docopt.docopt(__doc__)
+    transfers = split_transfers(read_trace(args['<trace_file>']))
+    if args['analyze']:
+        for records in transfers.values():
+            print(format_stats(analyze(records, float(args['--stall']), float(args['--interval']))))
+    elif args['replay']:
+        if args['<transfer>']:
+            transfer = int(args['<transfer>'])
+            transfers = {transfer: transfers.get(transfer, [])}
+        for records in transfers.values():
+            print(format_replay(replay(records)))
+#:
@@ -0,0 +1,56 @@
+"""
+Runs get and put transfers through the emulated link of the linkemu
+module and checks that they complete, with the right contents, despite
+lost, duplicated and reordered packets.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import linkemu
+
+SIZE = 64 * 1024              # bytes, 128 blocks
+TIMEOUT = 5.0                 # secs
+RETRANSMIT = 0.1              # secs
+
+CONDITIONS = {
+    'perfect': linkemu.PERFECT_LINK,
+    'delay': linkemu.LinkConditions(delay=0.002, jitter=0.002),
+    'loss': linkemu.LinkConditions(loss=0.05),
+    'duplicate': linkemu.LinkConditions(duplicate=0.2),
+    'reorder': linkemu.LinkConditions(reorder=0.2, duplicate=0.1),
+    'everything': linkemu.LinkConditions(loss=0.03, delay=0.001, jitter=0.002,
+                                         duplicate=0.05, reorder=0.05),
+}
+
+@pytest.mark.parametrize('name', CONDITIONS)
+def test_transfers_complete(name):
+    conditions = CONDITIONS[name]
+    results = linkemu.benchmark(conditions, conditions, size=SIZE, runs=2,
+                                timeout=TIMEOUT, seed=1, retransmit=RETRANSMIT)
+    assert [result.operation for result in results] == ['get', 'put', 'get', 'put']
+    # A result is only completed if the data received matches the source
+    for result in results:
+        assert result.completed, linkemu.format_result(result)
+        assert result.size == SIZE
+        assert result.error == ''
+
+def test_transfer_fails_when_link_is_down():
+    results = linkemu.benchmark(linkemu.LinkConditions(loss=1.0), size=SIZE,
+                                timeout=0.5, retransmit=RETRANSMIT)
+    assert results and not any(result.completed for result in results)
+    assert all('timed out' in result.error for result in results)
+
+def test_transfer_with_wrong_data_is_not_completed(monkeypatch):
+    iter_blocks = linkemu.tftp.iter_blocks
+    def swapped_blocks(source, block_size=linkemu.tftp.MAX_DATA_LEN):
+        blocks = list(iter_blocks(source, block_size))
+        blocks[1], blocks[2] = blocks[2], blocks[1]
+        return iter(blocks)
+    monkeypatch.setattr(linkemu.tftp, 'iter_blocks', swapped_blocks)
+    results = linkemu.benchmark(size=SIZE, timeout=TIMEOUT, retransmit=RETRANSMIT)
+    assert [result.error for result in results] == ['data differs from the source'] * 2
@@ -0,0 +1,106 @@
+"""
+Tests of phase timing and profiling of transfers.
+"""
+
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import profiling
+import server
+import storage
+import tftp
+
+@pytest.fixture
+def settings(monkeypatch, tmp_path):
+    for name, value in vars(profiling.ProfilingSettings()).items():
+        monkeypatch.setattr(profiling.settings, name, value)
+    profiling.settings.output_dir = str(tmp_path)
+    return profiling.settings
+
+@pytest.fixture
+def serv():
+    files = storage.MemoryStorage({'a.bin': bytes(50000)})
+    serv = server.TFTPServer(('127.0.0.1', 0), server.PacketHandler, files)
+    threading.Thread(target=serv.serve_forever, daemon=True).start()
+    yield serv
+    serv.shutdown()
+    serv.server_close()
+
+def _profiles(settings, prefix: str) -> list:
+    return [name for name in os.listdir(settings.output_dir) if name.startswith(prefix)]
+
+def test_phase_timer():
+    timer = profiling.PhaseTimer()
+    timer.add('send', 0.5)
+    timer.add('send', 0.25)
+    timer.add('read', 0.1)
+    phases = timer.stop()
+    assert list(phases) == [*profiling.PHASES, 'other']
+    assert phases['send'] == 0.75
+    assert phases['read'] == 0.1
+    assert phases['other'] == 0.0
+
+def test_profile_transfer_times_phases(settings, serv):
+    settings.timing = True
+    with profiling.profile_transfer('get') as phases:
+        tftp.get_to(serv.server_address, 'a.bin', io.BytesIO())
+    assert set(phases) == {*profiling.PHASES, 'other'}
+    assert phases['send'] > 0 and phases['recv'] > 0 and phases['write'] > 0
+    # Timing stops with the with block
+    assert tftp._timing.timer is None
+
+def test_profile_transfer_without_timing(settings, serv):
+    with profiling.profile_transfer('get') as phases:
+        tftp.get_to(serv.server_address, 'a.bin', io.BytesIO())
+    assert phases == {}
+    assert os.listdir(settings.output_dir) == []
+
+def test_cprofile_dump(settings, serv):
+    settings.profile_rate = 1.0
+    with profiling.profile_transfer('client/a.bin'):
+        tftp.get_to(serv.server_address, 'a.bin', io.BytesIO())
+    # The server profiled its side too
+    [name] = _profiles(settings, 'client_a.bin-')
+    assert name.endswith('.pstats')
+    stats = pstats.Stats(os.path.join(settings.output_dir, name))
+    assert any(func[2] == 'iter_get' for func in stats.stats)
+
+def test_sampling_profiler_dump(settings, serv):
+    settings.profile_rate = 1.0
+    settings.profiler = profiling.SAMPLING
+    with profiling.profile_transfer('client'):
+        for _ in range(20):
+            tftp.get_to(serv.server_address, 'a.bin', io.BytesIO())
+    [name] = _profiles(settings, 'client-')
+    assert name.endswith('.folded')
+    with open(os.path.join(settings.output_dir, name)) as file:
+        lines = file.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0 and ':' in stack
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='no SIGUSR1 on this platform')
+def test_signal_handlers_toggle_settings(settings):
+    handlers = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+    try:
+        profiling.install_signal_handlers(profile_rate=0.5)
+        signal.raise_signal(signal.SIGUSR1)
+        assert settings.timing
+        signal.raise_signal(signal.SIGUSR1)
+        assert not settings.timing
+        signal.raise_signal(signal.SIGUSR2)
+        assert settings.profile_rate == 0.5
+        signal.raise_signal(signal.SIGUSR2)
+        assert settings.profile_rate == 0.0
+    finally:
+        signal.signal(signal.SIGUSR1, handlers[0])
+        signal.signal(signal.SIGUSR2, handlers[1])
@@ -0,0 +1,68 @@
+"""
+Tests of the requests and failures handled by the TFTP server.
+"""
+
+import io
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import server
+import storage
+import tftp
+
+@pytest.fixture
+def serv():
+    files = storage.MemoryStorage({'a.bin': bytes(range(256)) * 8})
+    serv = server.TFTPServer(('127.0.0.1', 0), server.PacketHandler, files, 2.0, 0.1)
+    threading.Thread(target=serv.serve_forever, daemon=True).start()
+    yield serv
+    serv.shutdown()
+    serv.server_close()
+
+@pytest.fixture
+def client():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2.0)
+        yield sock
+
+def test_get_and_put(serv):
+    received = io.BytesIO()
+    assert tftp.get_to(serv.server_address, 'a.bin', received) == 2048
+    assert received.getvalue() == bytes(range(256)) * 8
+    assert tftp.put_from(serv.server_address, [b'x' * 1000], 'b.bin') == 1000
+    assert serv.storage.open_read('b.bin').read() == b'x' * 1000
+
+def test_missing_file(serv):
+    with pytest.raises(tftp.Err) as ex:
+        tftp.get_to(serv.server_address, 'missing', io.BytesIO())
+    assert ex.value.error_code == tftp.FILE_NOT_FOUND
+
+@pytest.mark.parametrize('packet', [b'\x00', b'\x00\x09', b'\x00\x01abc', tftp.pack_ack(1)])
+def test_malformed_request(serv, client, packet):
+    client.sendto(packet, serv.server_address)
+    reply, _ = client.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+    assert tftp.unpack_err(reply)[0] == tftp.ILLEGAL_OPERATION
+
+def test_malformed_packet_during_transfer(serv, client):
+    client.sendto(tftp.pack_rrq('a.bin'), serv.server_address)
+    _, tid = client.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+    client.sendto(b'\x00\x04', tid)
+    reply, _ = client.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+    assert tftp.unpack_err(reply)[0] == tftp.ILLEGAL_OPERATION
+
+def test_local_failure_is_reported(serv):
+    class FailingFile(io.BytesIO):
+        def read(self, size=-1):
+            if self.tell():
+                raise PermissionError('gone')
+            return super().read(size)
+    serv.storage.open_read = lambda name: FailingFile(bytes(2048))
+    with pytest.raises(tftp.Err) as ex:
+        tftp.get_to(serv.server_address, 'a.bin', io.BytesIO(), timeout=1.0)
+    assert ex.value.error_code == tftp.ACCESS_VIOLATION
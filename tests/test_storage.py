@@ -0,0 +1,230 @@
+"""
+Tests of the storage backends: name confinement, uploads and archives.
+"""
+
+import io
+import os
+import sys
+import tarfile
+import threading
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import storage
+
+@pytest.mark.parametrize('name, expected', [
+    ('a.txt', 'a.txt'),
+    ('/boot/pxelinux.0', 'boot/pxelinux.0'),
+    ('boot\\pxelinux.0', 'boot/pxelinux.0'),
+    ('boot/./x//y', 'boot/x/y'),
+    ('boot/../a.txt', 'a.txt'),
+])
+def test_normalize_name(name, expected):
+    assert storage.normalize_name(name) == expected
+
+@pytest.mark.parametrize('name', ['..', '../etc/passwd', '/../x', 'a/../../x', '..\\x'])
+def test_normalize_name_refuses_escapes(name):
+    with pytest.raises(PermissionError):
+        storage.normalize_name(name)
+
+@pytest.mark.parametrize('name', ['', '/', '.'])
+def test_normalize_name_refuses_empty_names(name):
+    with pytest.raises(FileNotFoundError):
+        storage.normalize_name(name)
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'root'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_bytes(b'hello')
+    (root / 'sub' / 'b.bin').write_bytes(bytes(1000))
+    (tmp_path / 'secret').write_bytes(b'secret')
+    return root
+
+def test_directory_confines_names(tree):
+    files = storage.DirectoryStorage(str(tree))
+    assert files._path('sub/b.bin') == os.path.join(str(tree), 'sub', 'b.bin')
+    with pytest.raises(PermissionError):
+        files._path('../secret')
+    with pytest.raises(PermissionError):
+        files.open_read('sub/../../secret')
+
+def test_directory_refuses_symlink_escapes(tree):
+    os.symlink(tree.parent / 'secret', tree / 'link')
+    os.symlink(tree.parent, tree / 'up')
+    os.symlink(tree / 'a.txt', tree / 'inside')
+    files = storage.DirectoryStorage(str(tree))
+    for name in ('link', 'up/secret'):
+        with pytest.raises(PermissionError):
+            files.open_read(name)
+    with files.open_read('inside') as file:
+        assert file.read() == b'hello'
+    assert sorted(entry.name for entry in files.list()) == ['a.txt', 'inside', 'sub/b.bin']
+
+def test_directory_skips_special_files(tree):
+    os.mkfifo(tree / 'fifo')
+    files = storage.DirectoryStorage(str(tree))
+    assert 'fifo' not in [entry.name for entry in files.list()]
+    with pytest.raises(FileNotFoundError):
+        files.open_read('fifo')
+
+def test_directory_upload_commit(tree):
+    files = storage.DirectoryStorage(str(tree))
+    with files.open_write('sub/new.bin') as upload:
+        upload.write(b'abc')
+        # Invisible until committed
+        assert not (tree / 'sub' / 'new.bin').exists()
+    assert (tree / 'sub' / 'new.bin').read_bytes() == b'abc'
+    assert files.stat('sub/new.bin').size == 3
+    assert sorted(os.listdir(tree / 'sub')) == ['b.bin', 'new.bin']
+
+def test_directory_upload_abort(tree):
+    files = storage.DirectoryStorage(str(tree))
+    with pytest.raises(RuntimeError):
+        with files.open_write('new.bin') as upload:
+            upload.write(b'abc')
+            raise RuntimeError('transfer failed')
+    upload = files.open_write('other.bin')
+    upload.write(b'abc')
+    upload.close()
+    assert sorted(os.listdir(tree)) == ['a.txt', 'sub']
+
+def test_directory_upload_refuses_existing_files(tree):
+    files = storage.DirectoryStorage(str(tree))
+    with pytest.raises(FileExistsError):
+        files.open_write('a.txt')
+    first, second = files.open_write('new.bin'), files.open_write('new.bin')
+    first.write(b'1')
+    second.write(b'2')
+    first.commit()
+    with pytest.raises(FileExistsError):
+        second.commit()
+    assert (tree / 'new.bin').read_bytes() == b'1'
+    assert sorted(os.listdir(tree)) == ['a.txt', 'new.bin', 'sub']
+
+def test_memory_upload():
+    files = storage.MemoryStorage({'a': b'1'})
+    with files.open_write('b') as upload:
+        upload.write(b'22')
+    with pytest.raises(ValueError):
+        with files.open_write('c') as upload:
+            upload.write(b'333')
+            raise ValueError('transfer failed')
+    assert sorted(entry.name for entry in files.list()) == ['a', 'b']
+    assert files.open_read('b').read() == b'22'
+    with pytest.raises(FileExistsError):
+        files.open_write('a')
+
+def test_read_only_storage_refuses_uploads(tree):
+    with pytest.raises(PermissionError):
+        storage.DirectoryStorage(str(tree), read_only=True).open_write('new.bin')
+
+ARCHIVE_FILES = {'a.txt': b'hello', 'sub/b.bin': bytes(range(256)) * 10}
+
+def _make_tar(path, mode):
+    with tarfile.open(path, mode) as tar:
+        for name, data in ARCHIVE_FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        evil = tarfile.TarInfo('../evil')
+        tar.addfile(evil, io.BytesIO())
+
+def _make_zip(path, mode):
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, data in ARCHIVE_FILES.items():
+            archive.writestr(name, data)
+        archive.writestr('../evil', b'')
+
+@pytest.mark.parametrize('suffix, make, mode', [
+    ('zip', _make_zip, None),
+    ('tar', _make_tar, 'w'),
+    ('tgz', _make_tar, 'w:gz'),
+])
+def test_archive_storage(tmp_path, suffix, make, mode):
+    path = str(tmp_path / f'files.{suffix}')
+    make(path, mode)
+    files = storage.open_storage(path)
+    assert isinstance(files, storage.ArchiveStorage)
+    assert sorted(entry.name for entry in files.list()) == sorted(ARCHIVE_FILES)
+    for name, data in ARCHIVE_FILES.items():
+        assert files.stat(name).size == len(data)
+        with files.open_read('/' + name) as file:
+            assert file.read() == data
+        assert files.read_block(name, 2, 512) == data[512:1024]
+    with pytest.raises(FileNotFoundError):
+        files.open_read('missing')
+    with pytest.raises(PermissionError):
+        files.open_read('../evil')
+    with pytest.raises(PermissionError):
+        files.open_write('new.bin')
+
+def test_indexed_storage_lookups(tree):
+    files = storage.IndexedStorage(storage.DirectoryStorage(str(tree)))
+    assert sorted(entry.name for entry in files.list()) == ['a.txt', 'sub/b.bin']
+    assert files.stat('/sub//b.bin').size == 1000
+    with files.open_read('a.txt') as file:
+        assert file.read() == b'hello'
+    # Not indexed yet: refused without looking at the disk
+    (tree / 'late.txt').write_bytes(b'late')
+    with pytest.raises(FileNotFoundError):
+        files.open_read('late.txt')
+    with pytest.raises(FileNotFoundError):
+        files.open_read('A.TXT')
+    with pytest.raises(PermissionError):
+        files.open_read('../secret')
+    files.rescan()
+    assert files.stat('late.txt').size == 4
+
+def test_indexed_storage_ignore_case(tree):
+    (tree / 'A.txt').write_bytes(b'upper')
+    files = storage.IndexedStorage(storage.DirectoryStorage(str(tree)), ignore_case=True)
+    assert files.resolve('SUB/B.BIN') == 'sub/b.bin'
+    # Exact matches first, then the first name in sorted order
+    assert files.resolve('a.txt') == 'a.txt'
+    assert files.resolve('a.TXT') == 'A.txt'
+    with pytest.raises(FileExistsError):
+        files.open_write('SUB/b.BIN')
+
+def test_indexed_storage_adds_uploads(tree):
+    files = storage.IndexedStorage(storage.DirectoryStorage(str(tree)))
+    with files.open_write('new.bin') as upload:
+        upload.write(b'abc')
+    assert files.stat('new.bin').size == 3
+    with pytest.raises(OSError):
+        with files.open_write('aborted.bin') as upload:
+            upload.write(b'abc')
+            raise OSError('transfer failed')
+    with pytest.raises(FileNotFoundError):
+        files.stat('aborted.bin')
+
+def test_indexed_storage_keeps_uploads_during_rescan():
+    listing = threading.Event()
+    resume = threading.Event()
+
+    class SlowStorage(storage.MemoryStorage):
+        slow = False
+
+        def list(self):
+            entries = super().list()
+            if self.slow:
+                listing.set()
+                resume.wait(5)
+            return entries
+
+    backend = SlowStorage({'a': b'1'})
+    files = storage.IndexedStorage(backend)
+    backend.slow = True
+    rescan = threading.Thread(target=files.rescan)
+    rescan.start()
+    assert listing.wait(5)
+    # Committed after the backend was listed, before the index is swapped
+    with files.open_write('new') as upload:
+        upload.write(b'22')
+    resume.set()
+    rescan.join()
+    assert sorted(entry.name for entry in files.list()) == ['a', 'new']
+    assert files.stat('new').size == 2
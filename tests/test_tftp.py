@@ -0,0 +1,107 @@
+"""
+Tests of the streaming transfer functions of the tftp module, against a
+scripted server socket.
+"""
+
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import tftp
+
+FULL_BLOCK = bytes(tftp.MAX_DATA_LEN)
+
+class Consumer:
+    """
+    Asks a generator for its next item in a thread, so that the test can
+    play the server meanwhile.
+    """
+    def __init__(self, generator):
+        self.generator = generator
+        self.item = None
+        self._thread = None
+    #:
+
+    def ask(self):
+        def run():
+            self.item = next(self.generator, None)
+        self._thread = threading.Thread(target=run)
+        self._thread.start()
+    #:
+
+    def wait(self):
+        self._thread.join(2.0)
+        assert not self._thread.is_alive()
+        return self.item
+    #:
+#:
+
+@pytest.fixture
+def serv_sock():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(2.0)
+        yield sock
+
+def _recv(sock) -> bytes:
+    return sock.recvfrom(tftp.SOCKET_BUFFER_SIZE)[0]
+
+def _assert_nothing_sent(sock):
+    sock.settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        sock.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+    sock.settimeout(2.0)
+
+def _start_get(serv_sock):
+    consumer = Consumer(tftp.iter_get(serv_sock.getsockname(), 'f', timeout=2.0, retransmit=5.0))
+    consumer.ask()
+    packet, client_addr = serv_sock.recvfrom(tftp.SOCKET_BUFFER_SIZE)
+    assert tftp.unpack_opcode(packet) == tftp.RRQ
+    serv_sock.sendto(tftp.pack_dat(1, FULL_BLOCK), client_addr)
+    assert consumer.wait() == FULL_BLOCK
+    return consumer, client_addr
+
+def test_iter_get_acks_on_demand(serv_sock):
+    consumer, client_addr = _start_get(serv_sock)
+    # The consumer holds block 1: it isn't acknowledged yet
+    _assert_nothing_sent(serv_sock)
+    consumer.ask()
+    assert _recv(serv_sock) == tftp.pack_ack(1)
+    serv_sock.sendto(tftp.pack_dat(2, b'end'), client_addr)
+    assert consumer.wait() == b'end'
+    # The last block is acknowledged before it is handed over
+    assert _recv(serv_sock) == tftp.pack_ack(2)
+    consumer.ask()
+    assert consumer.wait() is None
+    _assert_nothing_sent(serv_sock)
+
+def test_iter_get_reacks_repeated_blocks(serv_sock):
+    consumer, client_addr = _start_get(serv_sock)
+    consumer.ask()
+    assert _recv(serv_sock) == tftp.pack_ack(1)
+    serv_sock.sendto(tftp.pack_dat(1, FULL_BLOCK), client_addr)
+    assert _recv(serv_sock) == tftp.pack_ack(1)
+    serv_sock.sendto(tftp.pack_dat(2, b''), client_addr)
+    assert consumer.wait() == b''
+
+def test_iter_get_cancels_when_closed(serv_sock):
+    consumer, _ = _start_get(serv_sock)
+    consumer.generator.close()
+    error_code, _ = tftp.unpack_err(_recv(serv_sock))
+    assert error_code == tftp.UNDEF_ERROR
+
+@pytest.mark.parametrize('size', [0, 1, 511, 512, 513, 1024, 5000])
+@pytest.mark.parametrize('chunk', [1, 100, 512, 4096])
+def test_iter_blocks(size, chunk):
+    data = bytes(n % 251 for n in range(size))
+    chunks = [data[start:start + chunk] for start in range(0, size, chunk)]
+    blocks = list(tftp.iter_blocks(chunks))
+    assert b''.join(blocks) == data
+    assert all(len(block) == tftp.MAX_DATA_LEN for block in blocks[:-1])
+    # The last block is always short, empty if size is a multiple of 512
+    assert len(blocks[-1]) == size % tftp.MAX_DATA_LEN
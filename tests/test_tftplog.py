@@ -0,0 +1,105 @@
+"""
+Tests of the logging setup: rate limiting, dropped records and the
+transfer summaries.
+"""
+
+import io
+import logging
+import os
+import queue
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import tftplog
+
+def _record(msg: str, **extra) -> logging.LogRecord:
+    record = logging.LogRecord('tftp.test', logging.INFO, __file__, 0, msg, (), None)
+    record.__dict__.update(extra)
+    return record
+
+def test_rate_limit_filter_suppresses_repeated_templates(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(tftplog.time, 'monotonic', lambda: now[0])
+    rate_filter = tftplog.RateLimitFilter(rate=3, interval=1.0)
+    passed = [rate_filter.filter(_record('refused %s')) for _ in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+    # Other templates have their own window
+    assert rate_filter.filter(_record('other'))
+    # The first record of the next window reports the suppressed ones
+    now[0] += 1.0
+    record = _record('refused %s')
+    assert rate_filter.filter(record)
+    assert record.suppressed == 7
+
+def test_rate_limit_filter_lets_summaries_through():
+    rate_filter = tftplog.RateLimitFilter(rate=3, interval=60.0)
+    assert all(rate_filter.filter(_record('transfer', **{tftplog.NO_RATE_LIMIT: True}))
+               for _ in range(100))
+
+@pytest.fixture
+def log():
+    output = io.StringIO()
+    listener = tftplog.setup_logging('INFO', logging.StreamHandler(output), rate=5, interval=60.0)
+    yield listener, output
+    logger = logging.getLogger(tftplog.LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+def test_summaries_are_not_rate_limited(log):
+    listener, output = log
+    logger = logging.getLogger('tftp.server')
+    for _ in range(50):
+        tftplog.log_transfer(logger, 'get', ('10.0.0.2', 5001), 'boot img', 1024, 0.5,
+                             retransmits=2, read=0.1)
+        logger.info('request refused: %s', 'nope')
+    listener.stop()
+    lines = output.getvalue().splitlines()
+    summaries = [line for line in lines if ': transfer ' in line]
+    assert len(summaries) == 50
+    assert sum('request refused' in line for line in lines) == 5
+    assert summaries[0].endswith("INFO tftp.server: transfer operation=get client=10.0.0.2:5001 "
+                                 "file='boot img' bytes=1024 duration=0.5 retransmits=2 read=0.1")
+
+def test_failed_transfer_summary(log):
+    listener, output = log
+    tftplog.log_transfer(logging.getLogger('tftp.server'), 'put', ('10.0.0.2', 5001), 'f', 512, 1.0,
+                         'TimeoutError: timed out')
+    listener.stop()
+    line = output.getvalue().strip()
+    assert 'WARNING tftp.server: transfer failed' in line
+    assert line.endswith("bytes=512 duration=1.0 retransmits=0 error='TimeoutError: timed out'")
+
+def test_dropped_records_are_reported():
+    log_queue = queue.Queue(2)
+    handler = tftplog.DroppingQueueHandler(log_queue)
+    for n in range(5):
+        handler.handle(_record(f'message {n}'))
+    assert handler.dropped == 3
+    log_queue.get_nowait()
+    log_queue.get_nowait()
+    handler.handle(_record('after'))
+    assert log_queue.get_nowait().dropped == 3
+    assert handler.unreported == 0
+
+def test_listener_reports_drops_when_stopped(monkeypatch):
+    monkeypatch.setattr(tftplog, 'QUEUE_SIZE', 3)
+    output = io.StringIO()
+    listener = tftplog.setup_logging('INFO', logging.StreamHandler(output), rate=100)
+    try:
+        # Stop the writing thread so that the queue fills up
+        listener.stop()
+        logger = logging.getLogger('tftp.test')
+        for n in range(10):
+            logger.info('message %d', n)
+        listener.start()
+        listener.stop()
+    finally:
+        root = logging.getLogger(tftplog.LOGGER_NAME)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+    lines = output.getvalue().splitlines()
+    assert len(lines) == 4
+    assert lines[-1].endswith('WARNING tftp: log records dropped dropped=7')
@@ -0,0 +1,104 @@
+"""
+Tests of packet tracing: recording real transfers, then analyzing and
+replaying them.
+"""
+
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import linkemu
+import server
+import storage
+import tftp
+import tracing
+
+SIZE = 5000                   # bytes, 10 blocks
+
+@pytest.fixture
+def serv():
+    files = storage.MemoryStorage({'a.bin': bytes(SIZE)})
+    serv = server.TFTPServer(('127.0.0.1', 0), server.PacketHandler, files, 2.0, 0.05)
+    threading.Thread(target=serv.serve_forever, daemon=True).start()
+    yield serv
+    serv.shutdown()
+    serv.server_close()
+
+def _record(transfers) -> list:
+    trace = io.BytesIO()
+    recorder = tracing.TraceRecorder(trace)
+    tftp.set_tracer(recorder)
+    try:
+        transfers()
+        # put_resp dallies in the background after the last ACK
+        time.sleep(0.2)
+    finally:
+        tftp.set_tracer(None)
+        recorder.close()
+    trace.seek(0)
+    return tracing.read_trace(trace)
+
+def test_record_analyze_and_replay(serv):
+    def transfers():
+        tftp.get_to(serv.server_address, 'a.bin', io.BytesIO())
+        tftp.put_from(serv.server_address, [bytes(SIZE)], 'b.bin')
+    transfers = tracing.split_transfers(_record(transfers))
+    # Both sides of the get and of the put
+    assert len(transfers) == 4
+    roles = []
+    for records in transfers.values():
+        assert len({record.tid for record in records}) == 1
+        stats = tracing.analyze(records)
+        assert stats.data_bytes == SIZE
+        assert stats.retransmits == 0
+        result = tracing.replay(records)
+        assert result.error == ''
+        assert result.mismatches == []
+        roles.append(result.role)
+    assert sorted(roles) == ['get', 'get_resp', 'put', 'put_resp']
+
+def test_analyze_counts_retransmits(serv):
+    conditions = linkemu.LinkConditions(loss=0.1, duplicate=0.1)
+    with linkemu.LinkProxy(serv.server_address, conditions, conditions, seed=2) as proxy:
+        records = _record(lambda: tftp.get_to(proxy.address, 'a.bin', io.BytesIO(),
+                                              timeout=2.0, retransmit=0.05))
+    # A resent RRQ may start more server transfers, refused by the client
+    transfers = tracing.split_transfers(records).values()
+    clients = [records for records in transfers if records[0].opcode == tftp.RRQ]
+    assert len(clients) == 1
+    stats = tracing.analyze(clients[0])
+    # Retransmitted blocks are counted once in the data
+    assert stats.data_bytes == SIZE
+    assert sum(tracing.analyze(records).retransmits for records in transfers) > 0
+
+def test_read_trace_refuses_other_files():
+    with pytest.raises(ValueError):
+        tracing.read_trace(io.BytesIO(b'not a trace'))
+
+def _synthetic_transfer(blocks: int) -> list:
+    records = []
+    for n in range(1, blocks + 1):
+        block = n & tftp.MAX_BLOCK_NUMBER
+        length = 4 + (tftp.MAX_DATA_LEN if n < blocks else 10)
+        records.append(tracing.Record(n * 1e-4, tracing.OUT, 1, 5000, tftp.DAT, block, length))
+        records.append(tracing.Record(n * 1e-4, tracing.IN, 1, 5000, tftp.ACK, block, 4))
+    return records
+
+def test_analyze_handles_block_number_wrap():
+    blocks = 70000
+    records = _synthetic_transfer(blocks)
+    stats = tracing.analyze(records)
+    assert stats.data_bytes == (blocks - 1) * tftp.MAX_DATA_LEN + 10
+    assert stats.retransmits == 0
+    # A repeated block right after the wrap is still a retransmit
+    wrapped = 2 * (tftp.MAX_BLOCK_NUMBER + 1)
+    records.insert(wrapped + 2, records[wrapped])
+    stats = tracing.analyze(records)
+    assert stats.retransmits == 1
+    assert stats.data_bytes == (blocks - 1) * tftp.MAX_DATA_LEN + 10